@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — per-chat admission control
+Runs at the top of update dispatch, before any stats write, anchor update
+or API call:
+
+* token bucket per chat — a chat gets FLOOD_BURST updates at once and
+  FLOOD_RATE per second after that; the rest is dropped;
+* coalescer — the same slash command (/start, /help) from the same chat
+  within COALESCE_WINDOW seconds is merged into the first one. Button taps
+  are not coalesced: home -> category -> home inside the window is normal
+  navigation; a repeated tap of one button is left to Debounce.
+
+Debounce is the per-chat map process_callback uses for repeated taps on
+the same button.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+FLOOD_RATE = 1.0         # апдейтов в секунду на чат
+FLOOD_BURST = 8          # запас на быстрые серии (заполнение формы)
+COALESCE_WINDOW = 2.0
+MAX_CHATS = 100000       # LRU: состояние самых давних чатов забывается
+DEBOUNCE_WINDOW = 1.0    # повторное нажатие той же кнопки
+
+ADMIT, DROP, MERGE = "admit", "drop", "merge"
+
+class Admission:
+    """Решает, обрабатывать ли апдейт чата; хранит ограниченное число чатов"""
+
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST, window=COALESCE_WINDOW, max_chats=MAX_CHATS, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.window = window
+        self.max_chats = max_chats
+        self.clock = clock
+        self.buckets = OrderedDict()  # chat_id -> [tokens, last_refill]
+        self.recent = OrderedDict()   # (chat_id, command) -> ts первого в окне
+        self.counts = {ADMIT: 0, DROP: 0, MERGE: 0}
+        self.offenders = OrderedDict()  # chat_id -> отброшено/склеено (top для отчётов)
+        self._lock = threading.Lock()
+
+    def check(self, chat_id, command=None):
+        """ADMIT, DROP или MERGE; command — ключ склейки (None — не склеивать)"""
+        now = self.clock()
+        with self._lock:
+            if command is not None:
+                key = (chat_id, command)
+                self._expire(now)
+                if key in self.recent:
+                    return self._reject(chat_id, MERGE)
+            b = self.buckets.get(chat_id)
+            if b is None:
+                b = self.buckets[chat_id] = [self.burst, now]
+                if len(self.buckets) > self.max_chats:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(chat_id)
+                b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+                b[1] = now
+            if b[0] < 1.0:
+                return self._reject(chat_id, DROP)
+            b[0] -= 1.0
+            if command is not None:
+                self.recent[key] = now
+            self.counts[ADMIT] += 1
+            return ADMIT
+
+    def _expire(self, now):
+        # записи упорядочены по времени, просроченные — в начале
+        recent = self.recent
+        while recent:
+            key, ts = next(iter(recent.items()))
+            if now - ts < self.window:
+                break
+            recent.popitem(last=False)
+
+    def _reject(self, chat_id, result):
+        self.counts[result] += 1
+        n = self.offenders.pop(chat_id, 0) + 1
+        self.offenders[chat_id] = n
+        if len(self.offenders) > self.max_chats:
+            self.offenders.popitem(last=False)
+        return result
+
+    def top_offenders(self, n=10):
+        with self._lock:
+            return sorted(self.offenders.items(), key=lambda kv: -kv[1])[:n]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, chats=len(self.buckets))
+
+class Debounce:
+    """Последнее нажатие каждого чата; та же кнопка ещё раз в пределах окна — дубль"""
+
+    def __init__(self, window=DEBOUNCE_WINDOW, max_chats=MAX_CHATS, clock=time.monotonic):
+        self.window = window
+        self.max_chats = max_chats
+        self.clock = clock
+        self.last = OrderedDict()  # chat_id -> (data, ts)
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def check(self, chat_id, data):
+        """True — нажатие новое, False — дубль"""
+        now = self.clock()
+        with self._lock:
+            prev = self.last.pop(chat_id, None)
+            self.last[chat_id] = (data, now)
+            if len(self.last) > self.max_chats:
+                self.last.popitem(last=False)
+            if prev is not None and prev[0] == data and now - prev[1] < self.window:
+                self.hits += 1
+                return False
+            return True
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — Bot API outage benchmark
+Sends messages through bot_pro_fixed.send_message while the local fake API
+injects a fault, then lifts the fault and waits for deferred sends to be
+delivered. Shows per-call latency with and without the circuit breaker.
+
+    python bench_outage.py --fault hang --sends 30
+    python bench_outage.py --fault hang --sends 30 --no-breaker
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+
+import fake_api
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="send_message latency during a fake Bot API outage")
+    ap.add_argument("--fault", choices=fake_api.FAULT_MODES, default="hang")
+    ap.add_argument("--sends", type=int, default=30)
+    ap.add_argument("--no-breaker", action="store_true", help="never open the circuit (old behaviour)")
+    ap.add_argument("--recover-timeout", type=float, default=30)
+    args = ap.parse_args(argv)
+
+    port = free_port()
+    server, api = fake_api.serve(port)
+    os.environ["TELEGRAM_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["PROMPTBINDER_DATA"] = tempfile.mkdtemp()
+    import bot_pro_fixed as bot
+    if args.no_breaker:
+        bot.BREAKER.failure_threshold = float("inf")
+
+    api.set_fault(args.fault)
+    lat = []
+    t_all = time.perf_counter()
+    for i in range(args.sends):
+        t0 = time.perf_counter()
+        bot.send_message(100000 + i, f"outage probe {i}")
+        lat.append(time.perf_counter() - t0)
+    outage = time.perf_counter() - t_all
+    print(f"fault={args.fault} breaker={'off' if args.no_breaker else 'on'} sends={args.sends}")
+    print(f"  during outage: total {outage:6.2f}s  p50 {pct(lat, 0.5) * 1000:8.1f}ms  "
+          f"p95 {pct(lat, 0.95) * 1000:8.1f}ms  max {max(lat) * 1000:8.1f}ms")
+    print(f"  deferred sends: {len(bot.PENDING_SENDS)}")
+
+    api.set_fault(None)
+    t0 = time.perf_counter()
+    # после паузы reset цепь пропустит пробу; успешная проба закрывает её и досылает очередь
+    while time.perf_counter() - t0 < args.recover_timeout:
+        bot.send_message(1, f"recovery probe {time.time()}")
+        if not bot.PENDING_SENDS and bot.BREAKER.state == "closed":
+            break
+        time.sleep(0.5)
+    time.sleep(0.5)
+    delivered = sum(1 for s in api.sent if str(s["payload"].get("text", "")).startswith("outage probe"))
+    print(f"  after recovery: {delivered}/{args.sends} delivered in {time.perf_counter() - t0:.2f}s")
+    server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — session memory benchmark
+Measures bytes per active chat (tracemalloc) for the old dict-based anchor
+state and for the compact Session records in context_anchor.py.
+
+Usage:
+    python bench_sessions.py                    # 100k and 1M chats
+    python bench_sessions.py --sizes 10000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+import context_anchor
+
+CATEGORY = "✨ Креатив — идеи, слоганы"
+FIELDS = ["тема", "для кого", "цель"]
+
+def fill_legacy(n):
+    """Старое представление: USERS + DRAFTS + dict якоря с ISO-строками"""
+    users, drafts, states = {}, {}, {}
+    for i in range(n):
+        chat_id = 100000000 + i
+        states[chat_id] = {
+            'last_action': time.time(),
+            'current_category': CATEGORY,
+            'current_prompt': "idea",
+            'message_count': 3,
+            'last_keyboard': None,
+            'created_at': datetime.now().isoformat(),
+            'last_message': f"сообщение {i}",
+        }
+        if i % 3 == 0:
+            data = {"тема": f"тема {i}"}
+            users[chat_id] = {"state": "filling", "prompt_key": "idea",
+                              "fields": list(FIELDS), "index": 1, "data": data}
+            drafts[str(chat_id)] = {"prompt": "idea", "data": data}
+    return users, drafts, states
+
+def fill_compact(n, db_file):
+    anchor = context_anchor.ChatHistory(context_anchor.make_backend("sqlite", db_file))
+    for i in range(n):
+        chat_id = 100000000 + i
+        anchor.update_user_state(chat_id, current_category=CATEGORY, current_prompt="idea",
+                                 last_message=f"сообщение {i}")
+        if i % 3 == 0:
+            anchor.set_flow(chat_id, {"state": "filling", "prompt_key": "idea",
+                                      "fields": list(FIELDS), "index": 1,
+                                      "data": {"тема": f"тема {i}"}})
+    # dirty-набор после сброса на диск пуст — меряем установившееся состояние
+    anchor.save_history()
+    return anchor
+
+def measure(fn, *args):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    keep = fn(*args)
+    elapsed = time.perf_counter() - t0
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    return used, elapsed
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Bytes per chat: legacy dicts vs compact sessions")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            used, el = measure(fill_legacy, n)
+            print(f"legacy   {n:>8} chats  {used / n:8.1f} B/chat  {used / 2**20:8.1f} MiB  {el:6.1f}s")
+            db_file = os.path.join(tmp, f"bench_{n}.db")
+            used, el = measure(fill_compact, n, db_file)
+            print(f"compact  {n:>8} chats  {used / n:8.1f} B/chat  {used / 2**20:8.1f} MiB  {el:6.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — sharding throughput benchmark
+Runs sharding.py against the local fake API with 1..N workers and reports
+updates per second, once per --latency value (seconds the fake API adds to
+every outbound call):
+
+    latency 0     — CPU-bound: the speed-up is the CPU scaling of sharding and
+                    cannot exceed the number of cores (cpu_count is printed);
+    latency > 0   — I/O-bound: workers overlap Telegram round trips, so the
+                    speed-up can exceed the core count and says nothing about CPU.
+
+    python bench_sharding.py --workers 1 2 4 --updates 2000 --latency 0 0.02
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import fake_api
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(pred, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pred():
+            return True
+        time.sleep(0.05)
+    return False
+
+def run(workers, updates, latency, timeout):
+    port = free_port()
+    server, api = fake_api.serve(port, latency)
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ, TELEGRAM_API_BASE=f"http://127.0.0.1:{port}", PROMPTBINDER_DATA=data_dir)
+        proc = subprocess.Popen([sys.executable, os.path.join(BASE, "sharding.py"), "--workers", str(workers)],
+                                cwd=BASE, env=env)
+        try:
+            # прогрев: приёмник опрашивает API, воркеры успели импортировать бота
+            if not wait_for(lambda: api.counts.get("getUpdates", 0) >= 1, 30):
+                raise RuntimeError("bot did not start")
+            warm = [{"message": {"chat": {"id": -(i + 1)}, "text": "/start"}} for i in range(workers)]
+            api.inject(warm)
+            if not wait_for(lambda: api.counts.get("sendMessage", 0) >= workers, 60):
+                raise RuntimeError("workers did not warm up")
+            base = api.counts.get("sendMessage", 0)
+            # разные чаты, чтобы dedup якоря не схлопывал одинаковые ответы
+            batch = [{"message": {"chat": {"id": 1000 + i}, "text": "/start"}} for i in range(updates)]
+            t0 = time.perf_counter()
+            api.inject(batch)
+            ok = wait_for(lambda: api.counts.get("sendMessage", 0) - base >= updates, timeout)
+            elapsed = time.perf_counter() - t0
+            done = api.counts.get("sendMessage", 0) - base
+        finally:
+            proc.terminate()
+            proc.wait(10)
+            server.shutdown()
+    return done, elapsed, ok
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Throughput of sharding.py vs number of workers")
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--updates", type=int, default=1000)
+    ap.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.02],
+                    help="fake API latency per call, seconds; 0 measures CPU scaling")
+    ap.add_argument("--timeout", type=float, default=300)
+    args = ap.parse_args(argv)
+
+    print(f"cpu_count={os.cpu_count()} updates={args.updates}")
+    for latency in args.latency:
+        kind = "CPU-bound" if latency == 0 else "I/O-bound, overlapping API waits"
+        print(f"latency={latency}s ({kind})")
+        baseline = None
+        for n in args.workers:
+            done, elapsed, ok = run(n, args.updates, latency, args.timeout)
+            rate = done / elapsed if elapsed else 0.0
+            baseline = baseline or rate
+            flag = "" if ok else "  (timeout)"
+            print(f"workers={n:<3} {done:>6} upd  {elapsed:7.2f}s  {rate:8.1f} upd/s  x{rate / baseline:4.2f}{flag}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
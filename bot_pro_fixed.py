@@ -12,11 +12,37 @@ import requests
 import logging
 import traceback
 import re
+import random
+import threading
+import tempfile
+import signal
+import types
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 from datetime import datetime
 
+from catalog import load_catalog, render, parse_form, CB_HOME, CB_HELP, CB_COPY, CB_CATEGORY, CB_PROMPT, CB_RUN
+import admission
+import overload
+import breaker
+import generation
+import result_cache
+import bulk
+import broadcast
+import scheduler
+import pools
+from pools import HTTP
+import metrics
+import tracing
+from tracing import span
+from metrics import HANDLER_SECONDS, API_SECONDS, API_RESPONSES, FLUSH_SECONDS, UPDATES, QUEUE_DEPTH, DEDUP, LOOP_LAG, ADMISSION
+from metrics import DEGRADATION_LEVEL, OVERLOAD_PRESSURE, CIRCUIT_STATE, API_HEDGES, GEN_JOBS, GEN_SECONDS, RESULT_CACHE_LOOKUPS, RESULT_CACHE_HIT_RATE
+from metrics import BULK_JOBS, BULK_ROWS, BROADCAST_SENDS
+
 # Импортируем контекстный якорь
 try:
-    from context_anchor import anchor
+    from context_anchor import get_anchor, content_hash, ChatHistory, make_backend, AUTOSAVE_INTERVAL, GC_INTERVAL
     HAS_ANCHOR = True
 except ImportError:
     HAS_ANCHOR = False
@@ -30,20 +56,63 @@ try:
 except Exception:
     raise SystemExit("Create config.py with BOT_TOKEN in same folder.")
 
+# tenancy.py грузит по копии этого модуля на бота и до исполнения кладёт в неё
+# TENANT = {"name": ..., "BOT_TOKEN": ..., ...} — значения поверх config.py
+TENANT = globals().get("TENANT")
+if TENANT:
+    config = types.SimpleNamespace(**dict({k: v for k, v in vars(config).items() if not k.startswith("__")}, **TENANT))
+
 TOKEN = getattr(config, "BOT_TOKEN", None)
 ADMIN_CHAT_ID = getattr(config, "ADMIN_CHAT_ID", None)
 if not TOKEN:
     raise SystemExit("BOT_TOKEN missing in config.py")
 
-URL = f"https://api.telegram.org/bot{TOKEN}/"
+# TELEGRAM_API_BASE — локальный fake_api.py для бенчмарков и тестов
+API_BASE = os.environ.get("TELEGRAM_API_BASE") or getattr(config, "API_BASE", "https://api.telegram.org")
+URL = f"{API_BASE.rstrip('/')}/bot{TOKEN}/"
+FILE_URL = f"{API_BASE.rstrip('/')}/file/bot{TOKEN}/"
 
 BASE = os.path.dirname(os.path.abspath(__file__))
-PROMPTS_FILE = os.path.join(BASE, "prompts.json")
-STATS_FILE = os.path.join(BASE, "stats.csv")
-EVENT_LOG = os.path.join(BASE, "bot_events.log")
-ERROR_LOG = os.path.join(BASE, "bot_errors.log")
-SUMMARY_FILE = os.path.join(BASE, "summary.json")
-DRAFTS_FILE = os.path.join(BASE, "drafts.json")
+# статистика, логи и состояние; PROMPTBINDER_DATA позволяет вынести их из папки кода
+DATA_DIR = os.environ.get("PROMPTBINDER_DATA", BASE)
+if TENANT:
+    DATA_DIR = os.path.join(DATA_DIR, TENANT["name"])  # свои сессии, dedup, offset, stats и логи
+os.makedirs(DATA_DIR, exist_ok=True)
+BOT_NAME = TENANT["name"] if TENANT else ""
+
+def process_wide(name, factory):
+    """Пулы, очереди и планировщик: боты tenancy.py делят один на процесс, одиночный бот создаёт свой"""
+    return pools.shared(name, factory) if TENANT else factory()
+PROMPTS_FILE = os.path.join(BASE, getattr(config, "PROMPTS_FILE", "prompts.json"))
+STATS_FILE = os.path.join(DATA_DIR, "stats.csv")
+EVENT_LOG = os.path.join(DATA_DIR, "bot_events.log")
+ERROR_LOG = os.path.join(DATA_DIR, "bot_errors.log")
+# воркер sharding.py: свой summary, логи ротирует только приёмник
+SHARD = os.environ.get("PROMPTBINDER_SHARD")
+SUMMARY_FILE = os.path.join(DATA_DIR, f"summary.shard{SHARD}.json" if SHARD else "summary.json")
+CATALOG_CACHE = os.path.join(DATA_DIR, "catalog.cache")
+
+if HAS_ANCHOR and TENANT:
+    anchor = ChatHistory(make_backend(getattr(config, "STATE_BACKEND", None), os.path.join(DATA_DIR, "chat_history.db")))
+    atexit.register(anchor.save_history)
+elif HAS_ANCHOR:
+    anchor = get_anchor()
+# Лимит памяти под сессии якоря (МБ); холодные сессии уходят в chat_history.db
+if HAS_ANCHOR:
+    anchor.set_memory_budget(getattr(config, "ANCHOR_MEMORY_BUDGET_MB", None))
+
+# трассировка апдейтов: JSONL по строке на апдейт (см. tracing.py)
+_trace = os.environ.get("PROMPTBINDER_TRACE") or getattr(config, "TRACE_FILE", None)
+if _trace:
+    tracing.configure(os.path.join(DATA_DIR, _trace), getattr(config, "TRACE_MIN_MS", 0))
+PROFILE_MAX_SECONDS = 60
+
+# перегрузка: уровни деградации (см. overload.py)
+GOVERNOR = overload.Governor(getattr(config, "OVERLOAD_LATENCY", overload.LATENCY_HIGH),
+                             getattr(config, "OVERLOAD_ERROR_RATE", overload.ERROR_RATE_HIGH),
+                             getattr(config, "OVERLOAD_QUEUE", overload.QUEUE_HIGH))
+SAMPLED_EVENTS = {"recv", "send_ok", "field"}  # можно терять при перегрузке
+STATS_SAMPLE_RATE = 0.1
 
 logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger("PromptBinder")
@@ -92,7 +161,11 @@ def ensure_stats_header():
         except Exception:
             log_error("cannot create stats.csv")
 
+@FLUSH_SECONDS.time(store="stats")
+@span("append_stat")
 def append_stat(chat_id, event, detail="", prompt_key=""):
+    if event in SAMPLED_EVENTS and GOVERNOR.at_least(overload.SAMPLE_STATS) and random.random() >= STATS_SAMPLE_RATE:
+        return
     ensure_stats_header()
     try:
         with open(STATS_FILE, "a", encoding="utf-8") as f:
@@ -100,6 +173,7 @@ def append_stat(chat_id, event, detail="", prompt_key=""):
     except Exception as e:
         log_error(f"append_stat error: {e}")
 
+@FLUSH_SECONDS.time(store="summary")
 def save_summary(total_requests=0):
     stats_lines = 0
     try:
@@ -108,7 +182,8 @@ def save_summary(total_requests=0):
                 stats_lines = sum(1 for _ in f) - 1
     except:
         stats_lines = 0
-    summary = {"snapshot_at": now_ts(), "stats_lines": stats_lines, "requests": total_requests}
+    summary = {"snapshot_at": now_ts(), "stats_lines": stats_lines, "requests": total_requests,
+               "flood_top": FLOOD.top_offenders()}  # чаты, чаще всех упиравшиеся в лимит
     safe_write_json(SUMMARY_FILE, summary)
 
 # ---------------------------
@@ -187,144 +262,193 @@ SAMPLE = {
   }
 }
 
-if not os.path.exists(PROMPTS_FILE):
-    safe_write_json(PROMPTS_FILE, SAMPLE)
-    PROMPTS_RAW = SAMPLE
-    log_event("prompts.json not found → sample created")
-else:
-    try:
-        with open(PROMPTS_FILE, "r", encoding="utf-8") as f:
-            PROMPTS_RAW = json.load(f)
-    except Exception as e:
-        log_error(f"prompts.json parse error: {e} — recreating sample")
-        safe_write_json(PROMPTS_FILE, SAMPLE)
-        PROMPTS_RAW = SAMPLE
-
-CATEGORIES = PROMPTS_RAW.get("categories", [])[:6]
-PROMPTS = PROMPTS_RAW.get("prompts", {})
-
-while len(CATEGORIES) < 6:
-    CATEGORIES.append({"id": f"more{len(CATEGORIES)+1}", "title": "Другие", "icon": "➕", "items": []})
-
-# ---------------------------
-# Icon maps
-# ---------------------------
-PROMPT_ICONS = {
-    "idea": "💡",
-    "tagline": "✍️",
-    "ad": "📢",
-    "product": "📦",
-    "script": "🎞️",
-    "context": "💬",
-    "analysis": "📊",
-    "news": "📰",
-    "email": "✉️",
-    "structure": "🧱"
-}
-
-CATEGORY_DESC = {
-    "creative": "идеи, слоганы",
-    "marketing": "реклама, офферы",
-    "video": "сценарии, ролики",
-    "content": "посты, упрощение",
-    "crypto": "монеты, новости",
-    "work": "письма, структура"
-}
-
-# ---------------------------
-# Helpers re icons / cleaning
-# ---------------------------
-def starts_with_icon(s, icon):
-    if not s or not icon:
-        return False
-    s = s.strip()
-    return s.startswith(icon) or s.startswith(icon + " ")
-
-def strip_leading_icon(s):
-    if not s:
-        return s
-    s = s.strip()
-    if len(s) >= 2 and (not s[0].isalnum()) and s[1] == " ":
-        return s[2:].strip()
-    return s
-
-for c in CATEGORIES:
-    icon = (c.get("icon") or "").strip()
-    title = (c.get("title") or "").strip()
-    title_clean = strip_leading_icon(title)
-    desc = CATEGORY_DESC.get(c.get("id",""), "").strip()
-    if icon and not starts_with_icon(title, icon):
-        base = f"{icon} {title_clean}"
-    else:
-        base = title_clean
-    if desc:
-        c["button"] = f"{base} — {desc}"
-    else:
-        c["button"] = base
+CATALOG = load_catalog(PROMPTS_FILE, CATALOG_CACHE, SAMPLE, log_event, log_error)
+CATEGORIES = CATALOG["categories"]
+PROMPTS = CATALOG["prompts"]
+ROUTES = CATALOG["routes"]              # текст кнопки/названия -> ("category"|"prompt", id)
+ROUTES_LOWER = CATALOG["routes_lower"]  # название промпта в нижнем регистре -> key
+TEMPLATES = CATALOG["templates"]
+CALLBACKS = CATALOG["callbacks"]        # callback_data -> (action, category_id, prompt_key, page)
+FORMS = CATALOG["forms"]                # key -> бланк "поле: пример" для ответа одним сообщением
+# "form" — сразу показываем бланк и принимаем все поля одним сообщением; "steps" — по одному полю
+FORM_MODE = getattr(config, "FORM_MODE", "steps")
+# "inline" — меню на inline-кнопках: одно сообщение-меню на чат, переходы правят его (editMessageText)
+NAV_MODE = getattr(config, "NAV_MODE", "reply")
+INLINE = NAV_MODE == "inline"
 
 # ---------------------------
 # Keyboards (dicts)
 # ---------------------------
+# Клавиатуры собраны при компиляции каталога и не меняются — отдаём общие объекты
 def kb_categories():
-    kb = {"keyboard": [], "resize_keyboard": True, "one_time_keyboard": False}
-    for c in CATEGORIES:
-        kb["keyboard"].append([{"text": c["button"]}])
-    kb["keyboard"].append([{"text": "❓ Что может бот"}])
-    return kb
+    return CATALOG["ikb_categories"] if INLINE else CATALOG["kb_categories"]
 
-def kb_items(cat_id):
-    kb = {"keyboard": [], "resize_keyboard": True, "one_time_keyboard": False}
-    cat = next((x for x in CATEGORIES if x.get("id")==cat_id or x.get("button")==cat_id or x.get("title")==cat_id), None)
-    if not cat:
-        kb["keyboard"].append([{"text":"⬅️ Назад"}, {"text":"🏠 Домой"}])
-        return kb
-    items = cat.get("items", [])[:6]
-    row = []
-    for key in items:
-        p = PROMPTS.get(key)
-        if not p:
-            continue
-        title = strip_leading_icon(p.get("title",""))
-        icon_right = PROMPT_ICONS.get(key, "")
-        btn = f"{title}{'  ' + icon_right if icon_right else ''}"
-        row.append({"text": btn})
-        if len(row) == 2:
-            kb["keyboard"].append(row)
-            row = []
-    if row:
-        kb["keyboard"].append(row)
-    kb["keyboard"].append([{"text":"⬅️ Назад"}, {"text":"🏠 Домой"}])
+_KB_EMPTY = {"keyboard": [[{"text":"⬅️ Назад"}, {"text":"🏠 Домой"}]], "resize_keyboard": True, "one_time_keyboard": False}
+
+def kb_items(cat_id, page=0):
+    table = CATALOG["ikb_items"] if INLINE else CATALOG["kb_items"]
+    kb = table.get(cat_id)
+    if kb is None:
+        cat = next((x for x in CATEGORIES if x.get("button")==cat_id or x.get("title")==cat_id), None)
+        kb = table.get(cat["id"]) if cat else None
+    if kb is None:
+        return _KB_EMPTY
+    if INLINE:
+        return kb[min(page, len(kb) - 1)]  # inline: страницы по PAGE_SIZE промптов
     return kb
 
+def render_prompt(key, data):
+    return render(TEMPLATES.get(key, ()), data)
+
 def kb_cancel():
+    if INLINE:
+        return CATALOG["ikb_cancel"]
     return {"keyboard":[[{"text":"❌ Отмена"}]], "resize_keyboard": True, "one_time_keyboard": False}
 
 def inline_copy_kb():
-    return {"inline_keyboard":[[{"text":"📋 Скопировать промпт","callback_data":"copy_prompt"}]]}
+    row = [{"text":"📋 Скопировать промпт","callback_data":"copy_prompt"}]
+    if GEN_BACKEND:
+        row.append(CATALOG["ikb_run"])
+    return {"inline_keyboard":[row]}
 
 # ---------------------------
 # State
 # ---------------------------
+# Незавершённые формы живут в сессии якоря (переживают перезапуск);
+# без якоря — только в памяти процесса.
 USERS = {}  # chat_id -> state dict
-DRAFTS = safe_read_json(DRAFTS_FILE) if os.path.exists(DRAFTS_FILE) else {}
 
-def save_drafts():
-    safe_write_json(DRAFTS_FILE, DRAFTS)
+def get_flow(chat_id):
+    if HAS_ANCHOR:
+        return anchor.get_flow(chat_id)
+    return USERS.get(chat_id)
+
+def set_flow(chat_id, flow):
+    if HAS_ANCHOR:
+        anchor.set_flow(chat_id, flow)
+    else:
+        USERS[chat_id] = flow
+
+def clear_flow(chat_id):
+    if HAS_ANCHOR:
+        anchor.clear_flow(chat_id)
+    else:
+        USERS.pop(chat_id, None)
+
+VALUES = {}  # (chat_id, key) -> значение поля сессии, если якоря нет
+
+def get_value(chat_id, key):
+    return anchor.get_value(chat_id, key) if HAS_ANCHOR else VALUES.get((chat_id, key))
+
+def set_value(chat_id, key, value):
+    if HAS_ANCHOR:
+        anchor.set_value(chat_id, key, value)
+    else:
+        VALUES[(chat_id, key)] = value
+
+def get_menu(chat_id):
+    return get_value(chat_id, "menu_id")
+
+def set_menu(chat_id, message_id):
+    set_value(chat_id, "menu_id", message_id)
 
 # ---------------------------
 # Telegram helpers
 # ---------------------------
-def post(method, payload, timeout=12):
+CONNECT_TIMEOUT = 3.05   # недоступный хост не должен съедать весь timeout
+POLL_TIMEOUT = 20
+HEDGE_AFTER = POLL_TIMEOUT + 2  # long poll не вернулся вовремя — дублируем коротким опросом
+POLL_WORKERS = 4  # потоков getUpdates на бота: long poll, хедж и запас
+RETRY_METHODS = {"sendMessage", "editMessageText"}  # их при открытой цепи откладываем
+SEND_METHODS = RETRY_METHODS | {"sendDocument"}  # расходуют общий лимит отправок бота
+RETRY_MAX = 1000
+RETRY_TTL = 300
+
+BREAKER = breaker.CircuitBreaker(getattr(config, "BREAKER_FAILURES", breaker.FAILURE_THRESHOLD),
+                                 getattr(config, "BREAKER_RESET", breaker.RESET_TIMEOUT))
+PENDING_SENDS = deque(maxlen=RETRY_MAX)  # (method, payload, queued_at), старые вытесняются
+_flush_lock = threading.Lock()
+_poll_pool = process_wide("getUpdates", lambda: ThreadPoolExecutor(max_workers=POLL_WORKERS * pools.TENANTS,
+                                                                     thread_name_prefix="getUpdates"))
+STOPPING = threading.Event()  # SIGTERM: приём прекращается (см. Shutdown & handoff)
+# общий с рассылкой бюджет: ответы пользователям забирают долю рассылки, а не наоборот.
+# Бюджет живёт в процессе: воркеры sharding.py делят лимит бота поровну. Несколько
+# процессов с одним токеном за балансировщиком его не делят — /broadcast там запускать
+# только с GLOBAL_SEND_RATE, уменьшенным на число процессов.
+SEND_SHARDS = max(1, int(os.environ.get("PROMPTBINDER_SHARDS") or 1))
+SEND_BUDGET = broadcast.SendBudget(getattr(config, "GLOBAL_SEND_RATE", broadcast.GLOBAL_RATE) / SEND_SHARDS)
+
+def api_allowed(method, payload=None):
+    """False — цепь открыта: вызов не делаем; отправку сообщения откладываем до закрытия"""
+    if BREAKER.allow():
+        return True
+    API_RESPONSES.inc(method=method, status="circuit_open")
+    if payload is not None and method in RETRY_METHODS:
+        PENDING_SENDS.append((method, payload, time.time()))
+    return False
+
+def flush_pending():
+    """Досылает отложенные сообщения после закрытия цепи"""
+    if not _flush_lock.acquire(blocking=False):
+        return
+    sent = expired = 0
+    try:
+        while PENDING_SENDS and BREAKER.state == breaker.CLOSED:
+            method, payload, queued_at = PENDING_SENDS.popleft()
+            if time.time() - queued_at > RETRY_TTL:
+                expired += 1
+                continue
+            if post(method, payload) is not None:
+                sent += 1
+    finally:
+        _flush_lock.release()
+    log_event(f"pending_sends_flushed sent={sent} expired={expired} left={len(PENDING_SENDS)}")
+
+def on_circuit(state):
+    log_event(f"api_circuit={state}")
+    if state == breaker.CLOSED and PENDING_SENDS:
+        threading.Thread(target=flush_pending, name="flush-pending", daemon=True).start()
+
+BREAKER.on_change(on_circuit)
+
+def api_observed(method, t0, r, interactive=True):
+    """RTT и HTTP-статус вызова Bot API; r=None — сетевая ошибка"""
+    rtt = time.perf_counter() - t0
+    API_SECONDS.observe(rtt, method=method)
+    API_RESPONSES.inc(method=method, status=r.status_code if r is not None else "error")
+    # 4xx вроде 403 (бот заблокирован) — не перегрузка; 429 и 5xx — она,
+    # кроме 429 рассылки: она сама выжидает retry_after и не должна рвать цепь ответам
+    ok = r is not None and r.status_code < 500 and (r.status_code != 429 or not interactive)
+    GOVERNOR.record(None if method == "getUpdates" else rtt, ok)
+    if ok:
+        BREAKER.success()
+    else:
+        BREAKER.failure()
+
+def post(method, payload, timeout=12, interactive=True, defer=True):
+    """interactive=False — вызов рассылки: токен уже взят, при открытой цепи не откладываем;
+    defer=False — при открытой цепи не откладываем, у вызывающего свой запасной путь"""
+    if not api_allowed(method, payload if interactive and defer else None):
+        return None
+    if interactive and method in SEND_METHODS:
+        SEND_BUDGET.take()
+    t0 = time.perf_counter()
     try:
-        return requests.post(URL + method, json=payload, timeout=timeout)
+        with span(f"api.{method}"):
+            r = HTTP.post(URL + method, json=payload, timeout=(CONNECT_TIMEOUT, timeout))
     except Exception as e:
+        api_observed(method, t0, None, interactive)
         log_error(f"post error {method}: {e}")
         return None
+    api_observed(method, t0, r, interactive)
+    return r
 
-def send_message(chat_id, text, reply_markup=None, remove_keyboard=False):
+@HANDLER_SECONDS.time(handler="send_message")
+@span("send_message")
+def send_message(chat_id, text, reply_markup=None, remove_keyboard=False, dedup=True):
     # Проверяем через контекстный якорь, не отправляли ли уже это сообщение
-    if HAS_ANCHOR:
-        message_hash = hash(f"{text[:100]}{str(reply_markup)}")
+    if HAS_ANCHOR and dedup:
+        message_hash = content_hash(f"{text[:100]}{str(reply_markup)}")
         if not anchor.track_message(chat_id, f"msg_{message_hash}"):
             log_event(f"Duplicate message prevented for user {chat_id}")
             return None
@@ -353,19 +477,117 @@ def answer_callback(cb_id, text=None):
     payload = {"callback_query_id": cb_id}
     if text:
         payload["text"] = text
+    if not api_allowed("answerCallbackQuery"):
+        return  # ответ на callback устаревает за секунды — не откладываем
+    t0 = time.perf_counter()
     try:
-        requests.post(URL + "answerCallbackQuery", json=payload, timeout=8)
+        with span("api.answerCallbackQuery"):
+            r = HTTP.post(URL + "answerCallbackQuery", json=payload, timeout=(CONNECT_TIMEOUT, 8))
     except Exception as e:
+        api_observed("answerCallbackQuery", t0, None)
         log_error(f"answer_callback error: {e}")
+        return
+    api_observed("answerCallbackQuery", t0, r)
+
+_ack_pool = pools.ACKS  # общий для всех ботов процесса
+
+def answer_callback_async(cb_id, text=None):
+    """Ответ на callback уходит параллельно с обработкой нажатия"""
+    try:
+        _ack_pool.submit(answer_callback, cb_id, text)
+    except RuntimeError:  # пул закрыт при выходе
+        answer_callback(cb_id, text)
+
+def send_document(chat_id, path, caption=None):
+    data = {"chat_id": chat_id}
+    if caption:
+        data["caption"] = caption
+    if not api_allowed("sendDocument"):
+        log_error(f"send_document skipped, API circuit open: {path}")
+        return None
+    SEND_BUDGET.take()
+    t0 = time.perf_counter()
+    r = None
+    try:
+        with open(path, "rb") as f, span("api.sendDocument"):
+            r = HTTP.post(URL + "sendDocument", data=data, files={"document": f}, timeout=(CONNECT_TIMEOUT, 30))
+        return r
+    except Exception as e:
+        log_error(f"send_document error: {e}")
+        return None
+    finally:
+        api_observed("sendDocument", t0, r)
+
+def _get_updates(offset, timeout):
+    t0 = time.perf_counter()
+    r = None
+    try:
+        r = HTTP.get(URL + "getUpdates", params={"offset": offset, "timeout": timeout, "allowed_updates": ["message","callback_query"]},
+                         timeout=(CONNECT_TIMEOUT, timeout + 10))
+        return r
+    finally:
+        api_observed("getUpdates", t0, r)
+
+def get_updates(offset):
+    """getUpdates с хеджированием; None — цепь открыта или остановка. Повтор с тем же offset идемпотентен"""
+    if not api_allowed("getUpdates"):
+        return None
+    futures = [_poll_pool.submit(_get_updates, offset, POLL_TIMEOUT)]
+    deadline = time.monotonic() + HEDGE_AFTER
+    done = ()
+    while not done and time.monotonic() < deadline:
+        done, _ = wait(futures, min(0.25, max(0.0, deadline - time.monotonic())))
+        if not done and STOPPING.is_set():
+            # остановка: ответ брошенного long poll не подтверждён offset'ом — его получит преемник
+            return None
+    if not done:
+        # зависший long poll: короткий опрос заодно вытеснит его на стороне Telegram
+        API_HEDGES.inc()
+        futures.append(_poll_pool.submit(_get_updates, offset, 0))
+    error = None
+    for f in as_completed(futures):
+        try:
+            return f.result()
+        except Exception as e:
+            error = e
+    raise error
+
+def show_menu(chat_id, text, reply_markup, via=None):
+    """Меню в inline-режиме: правит сообщение-меню, если нажали в нём (via), иначе шлёт новое"""
+    if not INLINE:
+        return send_message(chat_id, text, reply_markup)
+    old = get_menu(chat_id)
+    edited = via is not None and via == old
+    if edited:
+        # правку не откладываем: при любой неудаче ниже шлём новое меню, оно и отложится
+        r = post("editMessageText", {"chat_id": chat_id, "message_id": via, "text": text,
+                                     "parse_mode": "HTML", "reply_markup": reply_markup}, defer=False)
+        try:
+            j = r.json() if r is not None else {}
+        except Exception:
+            j = {}
+        if j.get("ok") or "not modified" in str(j.get("description", "")):
+            append_stat(chat_id, "menu_edit", text[:80])
+            return j
+        # сеть, открытая цепь, меню удалено или слишком старое — шлём новое, мимо dedup:
+        # такое же меню уже отправляли, но показать его не удалось
+    j = send_message(chat_id, text, reply_markup, dedup=not edited)
+    if j and j.get("ok"):
+        set_menu(chat_id, (j.get("result") or {}).get("message_id"))
+        if old is not None:
+            # у прежнего меню снимаем кнопки, чтобы не жали в брошенное сообщение
+            post("editMessageReplyMarkup", {"chat_id": chat_id, "message_id": old,
+                                            "reply_markup": {"inline_keyboard": []}}, defer=False)
+    return j
 
 # ---------------------------
 # Processing logic
 # ---------------------------
-def start_chat(chat_id):
+def start_chat(chat_id, via=None):
     if HAS_ANCHOR:
         anchor.update_user_state(chat_id, current_category=None, current_prompt=None)
     
-    send_message(chat_id, "<b>👋 PromptBinder</b>\nВыберите категорию:", kb_categories())
+    show_menu(chat_id, "<b>👋 PromptBinder</b>\nВыберите категорию:", kb_categories(), via)
     append_stat(chat_id, "start", "")
 
 def help_chat(chat_id):
@@ -377,11 +599,12 @@ def help_chat(chat_id):
     txt = ("<b>Что умеет PromptBinder</b>\n\n"
            "• Быстро формирует промпты по шаблонам\n"
            "• Категории → выбор задачи → ввод полей → готовый промпт\n\n"
-           "Команды: /start /help /cancel")
-    send_message(chat_id, txt, kb_categories())
+           "Команды: /start /help /cancel\n"
+           "/bulk — промпты по CSV/JSONL-файлу")
+    show_menu(chat_id, txt, kb_categories())
     append_stat(chat_id, "help", "")
 
-def open_category(chat_id, label):
+def open_category(chat_id, label, via=None, page=0):
     if HAS_ANCHOR:
         anchor.update_user_state(chat_id, current_category=label)
     
@@ -395,62 +618,82 @@ def open_category(chat_id, label):
             if label == alt:
                 cat = c; break
     if not cat:
-        send_message(chat_id, "Не удалось найти категорию. Возврат в меню.", kb_categories())
+        show_menu(chat_id, "Не удалось найти категорию. Возврат в меню.", kb_categories())
         return
-    send_message(chat_id, f"<b>{cat.get('title')}</b>\nВыберите задачу:", kb_items(cat.get("id")))
+    show_menu(chat_id, f"<b>{cat.get('title')}</b>\nВыберите задачу:", kb_items(cat.get("id"), page), via)
     append_stat(chat_id, "open_category", cat.get("id"))
 
-def start_prompt_flow(chat_id, key):
+def start_prompt_flow(chat_id, key, via=None):
     p = PROMPTS.get(key)
     if not p:
-        send_message(chat_id, "Промпт не найден.", kb_categories())
+        show_menu(chat_id, "Промпт не найден.", kb_categories())
         return
     
     if HAS_ANCHOR:
         anchor.update_user_state(chat_id, current_prompt=key)
     
     fields = p.get("fields", []) or []
-    USERS[chat_id] = {"state":"filling","prompt_key":key,"fields":fields,"index":0,"data":{}}
-    if fields:
+    set_flow(chat_id, {"state":"filling","prompt_key":key,"fields":fields,"index":0,"data":{}})
+    if fields and FORM_MODE == "form" and len(fields) > 1:
+        show_menu(chat_id, f"<b>{p.get('title', key)}</b> — скопируйте бланк и заполните одним сообщением:\n"
+                              f"<code>{FORMS.get(key, '')}</code>\n"
+                              f"или ответьте на поля по очереди. Введите <b>{fields[0]}</b>:", kb_cancel(), via)
+        append_stat(chat_id, "start_prompt", key)
+    elif fields:
         first = fields[0]
         ex = p.get("fields_examples", {}).get(first, "")
         hint = f"\n<i>пример: {ex}</i>" if ex else ""
-        send_message(chat_id, f"Введите <b>{first}</b>:{hint}", kb_cancel())
+        show_menu(chat_id, f"Введите <b>{first}</b>:{hint}", kb_cancel(), via)
         append_stat(chat_id, "start_prompt", key)
     else:
-        template = p.get("template","")
-        out = re.sub(r"\{[^}]+\}","",template)
-        send_message(chat_id, f"<b>✨ Готово</b>\n<code>{out}</code>", inline_copy_kb(), remove_keyboard=True)
+        out = render_prompt(key, {})
+        remember_result(chat_id, key, {}, out)
+        if INLINE:
+            send_result(chat_id, f"<b>✨ Готово</b>\n<code>{out}</code>")
+        else:
+            send_message(chat_id, f"<b>✨ Готово</b>\n<code>{out}</code>", inline_copy_kb(), remove_keyboard=True)
         append_stat(chat_id, "prompt_generated", key)
 
+def send_result(chat_id, text):
+    """Inline-режим: результат и меню категорий одним сообщением; меню дальше — новое сообщение"""
+    kb = CATALOG["ikb_result"]
+    if GEN_BACKEND:
+        rows = kb["inline_keyboard"]
+        kb = {"inline_keyboard": [rows[0] + [CATALOG["ikb_run"]]] + rows[1:]}
+    send_message(chat_id, text, kb)
+    set_menu(chat_id, None)
+
 def finish_prompt(chat_id):
-    st = USERS.get(chat_id)
+    st = get_flow(chat_id)
     if not st:
-        send_message(chat_id, "Нет активного запроса. /start", kb_categories())
+        show_menu(chat_id, "Нет активного запроса. /start", kb_categories())
         return
     key = st["prompt_key"]
-    p = PROMPTS.get(key, {})
-    template = p.get("template","")
-    out = template
-    for k,v in st.get("data",{}).items():
-        out = out.replace("{" + k + "}", v)
-    out = re.sub(r"\{[^}]+\}","",out)
+    out = render_prompt(key, st.get("data", {}))
+    remember_result(chat_id, key, st.get("data", {}), out)
+    if INLINE:
+        send_result(chat_id, f"<b>✨ Ваш промпт</b>\n\n<code>{out}</code>")
+        append_stat(chat_id, "prompt_generated", key)
+        clear_flow(chat_id)
+        return  # меню уже в сообщении с результатом
     send_message(chat_id, f"<b>✨ Ваш промпт</b>\n\n<code>{out}</code>", inline_copy_kb(), remove_keyboard=True)
     append_stat(chat_id, "prompt_generated", key)
-    try:
-        del USERS[chat_id]
-    except:
-        pass
-    time.sleep(0.6)
+    clear_flow(chat_id)
+    if GOVERNOR.at_least(overload.SKIP_REMENU):
+        return  # экономим паузу и вызов API; меню вернёт /start
+    with span("remenu_pause"):
+        time.sleep(0.6)
     send_message(chat_id, "Выберите категорию:", kb_categories())
 
+@HANDLER_SECONDS.time(handler="process_text")
+@span("process_text")
 def process_text(chat_id, text):
     text = (text or "").strip()
     append_stat(chat_id, "recv", text[:120])
 
     # Обновляем состояние через якорь
     if HAS_ANCHOR:
-        anchor.update_user_state(chat_id, last_message=text)
+        anchor.update_user_state(chat_id, last_message=text[:120])
 
     # commands
     if text == "/start":
@@ -458,34 +701,43 @@ def process_text(chat_id, text):
     if text == "/help" or text == "❓ Что может бот":
         help_chat(chat_id); return
     if text in ("🏠 Домой", "Домой"):
-        USERS.pop(chat_id, None)
+        clear_flow(chat_id)
         if HAS_ANCHOR:
             anchor.clear_user_state(chat_id)
         start_chat(chat_id); return
     if text in ("⬅️ Назад", "/back"):
-        USERS.pop(chat_id, None)
+        clear_flow(chat_id)
         if HAS_ANCHOR:
             anchor.update_user_state(chat_id, current_prompt=None)
         start_chat(chat_id); return
     if text in ("❌ Отмена", "/cancel"):
-        USERS.pop(chat_id, None)
+        clear_flow(chat_id)
         if HAS_ANCHOR:
             anchor.clear_user_state(chat_id)
-        send_message(chat_id, "Отменено.", kb_categories()); return
+        show_menu(chat_id, "Отменено.", kb_categories()); return
     if text == "/export_stats":
         if ADMIN_CHAT_ID and str(chat_id) == str(ADMIN_CHAT_ID):
             if os.path.exists(STATS_FILE):
-                try:
-                    with open(STATS_FILE, "rb") as f:
-                        files = {"document": f}
-                        requests.post(URL + "sendDocument", data={"chat_id": chat_id}, files=files, timeout=30)
-                except Exception as e:
-                    log_error(f"export error: {e}")
+                send_document(chat_id, STATS_FILE)
             else:
                 send_message(chat_id, "Нет stats.csv")
         else:
             send_message(chat_id, "Команда доступна админу.")
         return
+    if text.split(" ")[0] == "/profile":
+        if ADMIN_CHAT_ID and str(chat_id) == str(ADMIN_CHAT_ID):
+            start_profiling(chat_id, text)
+        else:
+            send_message(chat_id, "Команда доступна админу.")
+        return
+    if text.split(" ")[0] == "/broadcast":
+        if ADMIN_CHAT_ID and str(chat_id) == str(ADMIN_CHAT_ID):
+            broadcast_command(chat_id, text)
+        else:
+            send_message(chat_id, "Команда доступна админу.")
+        return
+    if text.split(" ")[0] == "/bulk":
+        start_bulk(chat_id, text); return
     if text == "/context_info" and HAS_ANCHOR:
         state = anchor.get_user_state(chat_id)
         summary = anchor.get_chat_summary()
@@ -494,22 +746,30 @@ def process_text(chat_id, text):
         info += f"• Активных пользователей: {summary['total_users']}\n"
         info += f"• Всего сообщений: {summary['total_messages']}\n"
         info += f"• Активных сессий: {summary['active_sessions']}"
-        send_message(chat_id, info, kb_categories())
+        show_menu(chat_id, info, kb_categories())
         return
 
     # filling
-    if chat_id in USERS and USERS[chat_id].get("state") == "filling":
-        st = USERS[chat_id]
+    st = get_flow(chat_id)
+    if st and st.get("state") == "filling":
         idx = st["index"]
         fields = st["fields"]
         key = st["prompt_key"]
         if idx < len(fields):
-            fld = fields[idx]
-            st["data"][fld] = text
-            DRAFTS[str(chat_id)] = {"prompt": key, "data": st["data"]}
-            save_drafts()
-            st["index"] = idx + 1
-            append_stat(chat_id, "field", f"{fld}={text}", key)
+            values = parse_form(text, fields[idx:]) if FORM_MODE == "form" else None
+            if values:
+                # бланк целиком: одна запись flow и stats вместо записи на каждое поле
+                st["data"].update(values)
+                append_stat(chat_id, "form", ",".join(values), key)
+            else:
+                fld = fields[idx]
+                st["data"][fld] = text
+                append_stat(chat_id, "field", f"{fld}={text}", key)
+            # следующее незаполненное поле (бланк мог заполнить их не по порядку)
+            while idx < len(fields) and fields[idx] in st["data"]:
+                idx += 1
+            st["index"] = idx
+            set_flow(chat_id, st)
             if st["index"] >= len(fields):
                 finish_prompt(chat_id); return
             else:
@@ -519,24 +779,17 @@ def process_text(chat_id, text):
                 send_message(chat_id, f"Введите <b>{nextf}</b>:{hint}", kb_cancel())
                 return
 
-    # category click
-    for c in CATEGORIES:
-        if text == c.get("button") or text == c.get("title"):
-            open_category(chat_id, text); return
-
-    # item click matching (with right-side icon)
-    for key, p in PROMPTS.items():
-        title_clean = strip_leading_icon(p.get("title", "")) or ""
-        icon_right = PROMPT_ICONS.get(key, "")
-        btn_text = f"{title_clean}{'  ' + icon_right if icon_right else ''}"
-
-        if text == btn_text:
-            start_prompt_flow(chat_id, key)
-            return
-
-        if text == title_clean or text.lower() == title_clean.lower():
-            start_prompt_flow(chat_id, key)
-            return
+    # category / item click: одна выборка из индекса каталога
+    route = ROUTES.get(text)
+    if route is None and text.lower() in ROUTES_LOWER:
+        route = ("prompt", ROUTES_LOWER[text.lower()])
+    if route is not None:
+        kind, target = route
+        if kind == "category":
+            open_category(chat_id, text)
+        else:
+            start_prompt_flow(chat_id, target)
+        return
 
     # numeric map 1..6
     if text.isdigit():
@@ -549,102 +802,683 @@ def process_text(chat_id, text):
     # fallback
     lang = "ru" if re.search(r"[а-яА-Я]", text) else "en"
     ask = "Выберите категорию из меню 👇" if lang=="ru" else "Please choose a category 👇"
-    send_message(chat_id, ask, kb_categories())
+    show_menu(chat_id, ask, kb_categories())
+
+def start_profiling(chat_id, text):
+    """/profile [N] — сэмплирующий профиль всех потоков на N секунд, результат — файлом"""
+    parts = text.split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 10
+    except ValueError:
+        send_message(chat_id, "Формат: /profile 10")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    path = os.path.join(DATA_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+
+    def done(out_path, samples):
+        log_event(f"profile_done {out_path} samples={samples}")
+        send_document(chat_id, out_path, f"collapsed stacks, {seconds}s, {samples} samples — flamegraph.pl / speedscope")
+
+    if tracing.start_profile(seconds, path, done):
+        send_message(chat_id, f"Профилирую {seconds} с…")
+        append_stat(chat_id, "profile", str(seconds))
+    else:
+        send_message(chat_id, "Профилирование уже идёт.")
+
+# ---------------------------
+# Generation ("run it")
+# ---------------------------
+GEN_EDIT_INTERVAL = 1.5   # не чаще одной правки сообщения за столько секунд
+GEN_MAX_CHARS = 4096      # лимит текста сообщения Telegram
+
+_gen_base = getattr(config, "GEN_API_BASE", None)
+GEN_BACKEND = generation.Backend(_gen_base, getattr(config, "GEN_API_KEY", None),
+                                 getattr(config, "GEN_MODEL", "gpt-4o-mini")) if _gen_base else None
+def _gen_queue():
+    q = generation.JobQueue(getattr(config, "GEN_WORKERS", generation.GEN_WORKERS),
+                            getattr(config, "GEN_QUEUE_MAX", generation.GEN_QUEUE_MAX),
+                            getattr(config, "GEN_PER_CHAT", generation.GEN_PER_CHAT))
+    QUEUE_DEPTH.add_function(q.depth, queue="generation")
+    return q
+
+GEN_QUEUE = process_wide("generation", _gen_queue) if GEN_BACKEND else None
+
+def submit_job(q, chat_id, fn, what):
+    """Задача в очередь, возможно общую для ботов процесса: лимит на чат и лог ошибок — этого бота"""
+    def job():
+        try:
+            fn()
+        except Exception as e:
+            log_error(f"{what} job error {chat_id}: {e}")
+    return q.submit((BOT_NAME, chat_id), job)
+
+# одинаково заполненные формы не зовут backend повторно
+RESULT_CACHE = None
+if GEN_BACKEND:
+    RESULT_CACHE = result_cache.ResultCache(os.path.join(DATA_DIR, "results.db"),
+                                            disk_max_bytes=int(getattr(config, "RESULT_CACHE_MB", 50) * 1024 * 1024),
+                                            ttl=getattr(config, "RESULT_CACHE_TTL", result_cache.TTL))
+    for _tier in ("memory", "disk", "miss"):
+        RESULT_CACHE_LOOKUPS.add_function(lambda t=_tier: RESULT_CACHE.hits[t], tier=_tier)
+    RESULT_CACHE_HIT_RATE.add_function(RESULT_CACHE.lookups)
+
+def remember_result(chat_id, key, data, out):
+    """Последний промпт чата и ключ его результата в кэше — для кнопки «Запустить»"""
+    set_value(chat_id, "last_result", out)
+    if GEN_BACKEND:
+        set_value(chat_id, "last_result_key",
+                  result_cache.make_key(key, TEMPLATES.get(key, ()), data, GEN_BACKEND.model))
+
+def edit_text(chat_id, message_id, text):
+    return post("editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text[:GEN_MAX_CHARS]})
+
+def generate(chat_id, prompt, cache_key=None):
+    """Задача очереди: шлёт заглушку и правит её по мере генерации"""
+    # заглушка мимо dedup send_message: повторный запуск с тем же текстом — новое сообщение
+    r = post("sendMessage", {"chat_id": chat_id, "text": "⏳ Генерирую…"})
+    try:
+        mid = r.json()["result"]["message_id"]
+    except Exception:
+        GEN_JOBS.inc(result="error")
+        return
+    t0 = time.perf_counter()
+    text, last_edit = "", time.monotonic()
+    try:
+        for piece in GEN_BACKEND.stream(prompt):
+            text += piece
+            if time.monotonic() - last_edit >= GEN_EDIT_INTERVAL:
+                edit_text(chat_id, mid, text + " ▌")
+                last_edit = time.monotonic()
+    except Exception as e:
+        log_error(f"generation error {chat_id}: {e}")
+        edit_text(chat_id, mid, (text + "\n\n" if text else "") + "⚠️ Генерация прервалась, попробуйте ещё раз.")
+        GEN_JOBS.inc(result="error")
+        return
+    edit_text(chat_id, mid, text or "Пустой ответ.")
+    if text and cache_key:
+        RESULT_CACHE.put(cache_key, text)
+    GEN_SECONDS.observe(time.perf_counter() - t0)
+    GEN_JOBS.inc(result="ok")
+    append_stat(chat_id, "generated", str(len(text)))
+
+def run_generation(chat_id):
+    """Кнопка «Запустить»: ставит последний промпт чата в очередь генерации"""
+    prompt = get_value(chat_id, "last_result")
+    if not GEN_QUEUE or not prompt:
+        show_menu(chat_id, "Сначала соберите промпт.", kb_categories())
+        return
+    cache_key = get_value(chat_id, "last_result_key")
+    cached = RESULT_CACHE.get(cache_key) if cache_key else None
+    if cached is not None:
+        # готовый ответ: одно сообщение, без очереди и backend
+        post("sendMessage", {"chat_id": chat_id, "text": cached[:GEN_MAX_CHARS]})
+        GEN_JOBS.inc(result="cached")
+        append_stat(chat_id, "run", "cached")
+        return
+    result = submit_job(GEN_QUEUE, chat_id, lambda: generate(chat_id, prompt, cache_key), "generation")
+    GEN_JOBS.inc(result=result)
+    if result == generation.BUSY:
+        send_message(chat_id, "Уже генерирую для вас — дождитесь результата.")
+    elif result == generation.FULL:
+        send_message(chat_id, "Сейчас много запросов, попробуйте через минуту.")
+    append_stat(chat_id, "run", result)
+
+# ---------------------------
+# Bulk files
+# ---------------------------
+BULK_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API скачать не даёт
+BULK_MAX_ROWS = getattr(config, "BULK_MAX_ROWS", bulk.MAX_ROWS)
+DOWNLOAD_CHUNK = 64 * 1024
+
+def _bulk_queue():
+    q = generation.JobQueue(getattr(config, "BULK_WORKERS", 1), getattr(config, "BULK_QUEUE_MAX", 20), 1)
+    QUEUE_DEPTH.add_function(q.depth, queue="bulk")
+    return q
+
+BULK_QUEUE = process_wide("bulk", _bulk_queue)
+
+def start_bulk(chat_id, text):
+    """/bulk <ключ> — следующий документ чата рендерится этим шаблоном построчно"""
+    parts = text.split()
+    key = parts[1] if len(parts) > 1 else None
+    if key not in PROMPTS:
+        keys = "\n".join(f"<code>/bulk {k}</code> — {p.get('title', k)}" for k, p in list(PROMPTS.items())[:40])
+        send_message(chat_id, f"Укажите промпт:\n{keys}")
+        return
+    fields = PROMPTS[key].get("fields", []) or []
+    set_flow(chat_id, {"state": "bulk", "prompt_key": key})
+    send_message(chat_id, f"Пришлите CSV (первая строка — названия полей) или JSONL, по строке на промпт.\n"
+                          f"Поля: <code>{', '.join(fields) or '—'}</code>", kb_cancel())
+    append_stat(chat_id, "bulk_start", key)
+
+def process_document(chat_id, doc):
+    st = get_flow(chat_id)
+    if not st or st.get("state") != "bulk":
+        send_message(chat_id, "Чтобы обработать файл, сначала выберите промпт: /bulk")
+        return
+    if (doc.get("file_size") or 0) > BULK_MAX_BYTES:
+        send_message(chat_id, f"Файл больше {BULK_MAX_BYTES // (1024 * 1024)} МБ.")
+        return
+    key = st["prompt_key"]
+    result = submit_job(BULK_QUEUE, chat_id, lambda: bulk_job(chat_id, key, doc), "bulk")
+    BULK_JOBS.inc(result=result)
+    if result == generation.BUSY:
+        send_message(chat_id, "Предыдущий файл ещё обрабатывается.")
+        return
+    if result == generation.FULL:
+        send_message(chat_id, "Сейчас много файлов в очереди, попробуйте позже.")
+        return
+    clear_flow(chat_id)
+    append_stat(chat_id, "bulk_file", doc.get("file_name", "")[:120], key)
+
+def download_file(file_id, path):
+    """getFile и потоковое скачивание в path кусками — файл целиком в память не читается"""
+    r = post("getFile", {"file_id": file_id})
+    try:
+        file_path = r.json()["result"]["file_path"]
+    except Exception:
+        raise bulk.BulkError("не удалось получить файл")
+    with span("api.downloadFile"), HTTP.get(FILE_URL + file_path, stream=True, timeout=(CONNECT_TIMEOUT, 60)) as resp:
+        resp.raise_for_status()
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > BULK_MAX_BYTES:
+                    raise bulk.BulkError("файл слишком большой")
+                f.write(chunk)
+
+def bulk_job(chat_id, key, doc):
+    """Задача очереди: скачать, отрендерить построчно в .jsonl.gz, отправить; прогресс — правками одного сообщения"""
+    r = post("sendMessage", {"chat_id": chat_id, "text": "⏳ Файл получен, обрабатываю…"})
+    try:
+        mid = r.json()["result"]["message_id"]
+    except Exception:
+        mid = None
+
+    def progress(n):
+        if mid:
+            edit_text(chat_id, mid, f"⏳ Обработано строк: {n}…")
+
+    name = os.path.splitext(os.path.basename(doc.get("file_name") or "file"))[0]
+    with tempfile.TemporaryDirectory(prefix="bulk-") as tmp:
+        src = os.path.join(tmp, "input")
+        out = os.path.join(tmp, f"{key}-{name}.jsonl.gz")
+        try:
+            download_file(doc.get("file_id"), src)
+            rows = bulk.render_file(src, out, TEMPLATES.get(key, ()), bulk.detect_kind(src, doc.get("file_name")),
+                                    progress, BULK_MAX_ROWS)
+        except (bulk.BulkError, ValueError, UnicodeDecodeError, requests.RequestException) as e:
+            log_error(f"bulk error {chat_id}: {e}")
+            text = f"⚠️ Файл не обработан: {e}" if isinstance(e, bulk.BulkError) else "⚠️ Файл не обработан: нужен CSV или JSONL в UTF-8."
+            if mid:
+                edit_text(chat_id, mid, text)
+            else:
+                post("sendMessage", {"chat_id": chat_id, "text": text})
+            BULK_JOBS.inc(result="error")
+            return
+        BULK_ROWS.inc(rows)
+        if mid:
+            edit_text(chat_id, mid, f"✅ Готово: {rows} строк.")
+        send_document(chat_id, out, f"{PROMPTS.get(key, {}).get('title', key)}: {rows} промптов")
+    BULK_JOBS.inc(result="ok")
+    append_stat(chat_id, "bulk_done", str(rows), key)
+
+# ---------------------------
+# Broadcast
+# ---------------------------
+def broadcast_send(chat_id, text):
+    """Одна доставка рассылки: (результат, retry_after)"""
+    r = post("sendMessage", {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, interactive=False)
+    if r is None or r.status_code >= 500:
+        result, retry_after = broadcast.UNAVAILABLE, 0  # цепь открыта, сеть или сбой Telegram
+    elif r.status_code == 200:
+        result, retry_after = broadcast.SENT, 0
+    elif r.status_code == 429:
+        try:
+            retry_after = float(r.json()["parameters"]["retry_after"])
+        except Exception:
+            retry_after = 1.0
+        result = broadcast.RETRY
+    elif r.status_code == 403 or (r.status_code == 400 and "chat not found" in r.text):
+        result, retry_after = broadcast.BLOCKED, 0
+    else:
+        result, retry_after = broadcast.FAILED, 0
+    BROADCAST_SENDS.inc(result=result)
+    return result, retry_after
+
+def broadcast_done(st):
+    append_stat(st.get("admin") or "", "broadcast_" + st["status"], f"sent={st['sent']} blocked={st['blocked']} failed={st['failed']}")
+    if st.get("admin"):
+        post("sendMessage", {"chat_id": st["admin"], "text": broadcast_status(st)})
+
+def broadcast_status(st):
+    if not st:
+        return "Рассылок ещё не было."
+    took = (st.get("finished") or time.time()) - st["started"]
+    return (f"Рассылка {st['id']}: {st['status']}, {took:.0f} с\n"
+            f"доставлено {st['sent']}, заблокировали {st['blocked']}, ошибок {st['failed']}")
+
+BROADCAST = None
+if HAS_ANCHOR:
+    BROADCAST = broadcast.Broadcast(anchor.backend, broadcast_send, SEND_BUDGET,
+                                    getattr(config, "BROADCAST_LANES", broadcast.LANES),
+                                    on_done=broadcast_done, log=log_event)
+
+def broadcast_command(chat_id, text):
+    """/broadcast <текст> — запуск; /broadcast — статус; /broadcast stop | resume"""
+    if BROADCAST is None:
+        send_message(chat_id, "Рассылка работает только с context_anchor.")
+        return
+    arg = text[len("/broadcast"):].strip()
+    if not arg:
+        send_message(chat_id, broadcast_status(BROADCAST.state))
+    elif arg == "stop":
+        send_message(chat_id, "Останавливаю рассылку." if BROADCAST.stop() else "Рассылка не идёт.")
+    elif arg == "resume":
+        send_message(chat_id, "Продолжаю рассылку." if BROADCAST.resume() else "Продолжать нечего.")
+    else:
+        anchor.save_history()  # новые чаты — ещё только в памяти
+        if not BROADCAST.start(arg, chat_id):
+            send_message(chat_id, "Рассылка уже идёт: /broadcast stop")
+            return
+        n = anchor.get_chat_summary()["total_users"]
+        send_message(chat_id, f"Рассылка запущена: до {n} чатов, не меньше {n / SEND_BUDGET.rate:.0f} с.")
+        append_stat(chat_id, "broadcast_start", arg[:80])
+
+def resume_broadcast():
+    """Рассылка, прерванная перезапуском, продолжается с последнего чекпоинта"""
+    if BROADCAST and BROADCAST.state and BROADCAST.state.get("status") == "running" and BROADCAST.resume():
+        log_event(f"broadcast_resumed after={BROADCAST.state['after']}")
 
 # ---------------------------
 # Callback processing
 # ---------------------------
-_last_cb = None
+CB_DEBOUNCE = admission.Debounce(getattr(config, "CALLBACK_DEBOUNCE", admission.DEBOUNCE_WINDOW))
+ADMISSION.add_function(lambda: CB_DEBOUNCE.hits, result="debounce")
+
+@HANDLER_SECONDS.time(handler="process_callback")
+@span("process_callback")
 def process_callback(cb):
-    global _last_cb
-    cid = cb.get("id")
     data = cb.get("data")
     message = cb.get("message", {})
     chat_id = message.get("chat", {}).get("id")
-    
-    # debounce
-    key = f"{chat_id}:{data}"
-    if key == _last_cb:
-        answer_callback(cid)
+    via = message.get("message_id")
+
+    # на нажатие уже ответил handle_update
+    if not CB_DEBOUNCE.check(chat_id, data):
         return
-    _last_cb = key
-    
-    answer_callback(cid)
-    if data == "copy_prompt":
-        send_message(chat_id, "📋 Чтобы скопировать — выделите текст и нажмите «Копировать»", kb_categories())
+
+    route = CALLBACKS.get(data)
+    if route is None:
+        # кнопка из сообщения, отправленного до правки prompts.json
+        append_stat(chat_id, "callback_stale", str(data)[:64])
+        show_menu(chat_id, "Меню обновилось, выберите заново:", kb_categories())
+        return
+    action, cat_id, key, page = route
+    if action == CB_COPY:
+        show_menu(chat_id, "📋 Чтобы скопировать — выделите текст и нажмите «Копировать»", kb_categories())
         append_stat(chat_id, "copy", "")
+    elif action == CB_HOME:
+        clear_flow(chat_id)
+        start_chat(chat_id, via)
+    elif action == CB_HELP:
+        help_chat(chat_id)
+    elif action == CB_CATEGORY:
+        cat = next((c for c in CATEGORIES if c.get("id") == cat_id), None)
+        if cat:
+            open_category(chat_id, cat.get("button"), via, page)
+    elif action == CB_PROMPT:
+        start_prompt_flow(chat_id, key, via)
+    elif action == CB_RUN:
+        run_generation(chat_id)
+
+# ---------------------------
+# Update dispatch
+# ---------------------------
+# флуд-контроль до любой работы: без записи stats, якоря и вызовов API
+FLOOD = admission.Admission(getattr(config, "FLOOD_RATE", admission.FLOOD_RATE),
+                            getattr(config, "FLOOD_BURST", admission.FLOOD_BURST),
+                            getattr(config, "COALESCE_WINDOW", admission.COALESCE_WINDOW))
+for _result in (admission.ADMIT, admission.DROP, admission.MERGE):
+    ADMISSION.add_function(lambda r=_result: FLOOD.counts[r], result=_result)
+
+def admit(upd):
+    """True — апдейт обрабатываем; одинаковые /команды склеиваются, флуд отбрасывается"""
+    if "message" in upd:
+        m = upd["message"]
+        text = (m.get("text") or "").strip()
+        chat_id = m.get("chat", {}).get("id")
+        command = text if text.startswith("/") else None
+    elif "callback_query" in upd:
+        # нажатия не склеиваем (быстрая навигация по меню); повтор той же кнопки ловит CB_DEBOUNCE
+        chat_id = upd["callback_query"].get("message", {}).get("chat", {}).get("id")
+        command = None
+    else:
+        return True
+    return FLOOD.check(chat_id, command) == admission.ADMIT
+
+# апдейты этого бота для summary.json; UPDATES — общий на процесс (tenancy.py)
+_updates_seen = 0
+_updates_lock = threading.Lock()
+
+def count_update():
+    global _updates_seen
+    with _updates_lock:
+        _updates_seen += 1
+
+def handle_update(upd):
+    UPDATES.inc(kind="message" if "message" in upd else "callback_query" if "callback_query" in upd else "other")
+    count_update()
+    if "callback_query" in upd:
+        # Telegram ждёт ответа на каждое нажатие, в том числе отброшенное флуд-контролем или повторное
+        answer_callback_async(upd["callback_query"].get("id"))
+    if not admit(upd):
+        return
+    if "message" in upd:
+        m = upd["message"]
+        chat_id = m.get("chat", {}).get("id")
+        text = m.get("text","")
+        tracing.begin(upd.get("update_id"), chat_id)
+        try:
+            if "document" in m:
+                process_document(chat_id, m["document"])
+            else:
+                process_text(chat_id, text)
+        except Exception as e:
+            log_error(f"process_text error: {e}\n{traceback.format_exc()}")
+        finally:
+            tracing.end()
+    elif "callback_query" in upd:
+        cb = upd["callback_query"]
+        tracing.begin(upd.get("update_id"), cb.get("message", {}).get("chat", {}).get("id"))
+        try:
+            process_callback(cb)
+        except Exception as e:
+            log_error(f"callback error: {e}\n{traceback.format_exc()}")
+        finally:
+            tracing.end()
+
+# ---------------------------
+# Metrics
+# ---------------------------
+if HAS_ANCHOR:
+    for _result, _field in (("hit", "hits"), ("miss", "misses"), ("eviction", "evictions")):
+        DEDUP.add_function(lambda f=_field: anchor.backend.dedup_stats()[f], result=_result)
+    QUEUE_DEPTH.add_function(lambda: len(anchor.dirty), queue="anchor_dirty")
+DEGRADATION_LEVEL.add_function(lambda: GOVERNOR.level)
+CIRCUIT_STATE.add_function(lambda: breaker.STATE_CODES[BREAKER.state])
+QUEUE_DEPTH.add_function(lambda: len(PENDING_SENDS), queue="pending_sends")
+OVERLOAD_PRESSURE.add_function(lambda: GOVERNOR.pressure)
+
+def on_degradation(level):
+    log_event(f"degradation_level={level} pressure={GOVERNOR.pressure:.2f}")
+    if HAS_ANCHOR:
+        anchor.defer_saves = level >= overload.DEFER_PERSIST
+
+GOVERNOR.on_change(on_degradation)
+
+def start_metrics(offset=0):
+    """Поднимает /metrics, если задан METRICS_PORT; offset разводит порты воркеров"""
+    port = os.environ.get("PROMPTBINDER_METRICS_PORT") or getattr(config, "METRICS_PORT", None)
+    if not port or TENANT:  # у ботов tenancy.py один /metrics на процесс
+        return None
+    try:
+        server = metrics.serve(int(port) + offset)
+    except Exception as e:
+        log_error(f"metrics server error on port {port}+{offset}: {e}")
+        return None
+    log_event(f"metrics_start port={int(port) + offset}")
+    return server
+
+# ---------------------------
+# Maintenance
+# ---------------------------
+SUMMARY_INTERVAL = getattr(config, "SUMMARY_INTERVAL", 300)
+LOG_MAX_BYTES = getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024)
+COMPACT_INTERVAL = 600
+RESULT_CACHE_EXPIRE_INTERVAL = 3600
+
+MAINTENANCE = process_wide("maintenance", lambda: scheduler.Scheduler(
+    cpu_share=getattr(config, "MAINTENANCE_CPU_SHARE", scheduler.CPU_SHARE),
+    on_error=lambda name, e: log_error(f"maintenance {name} error: {e}")))
+_maintenance_jobs = []  # свои задачи в (возможно общем) планировщике
+
+def maintain(name, interval, fn):
+    """Задача обслуживания этого бота; у ботов tenancy.py имя с префиксом бота"""
+    name = f"{BOT_NAME}:{name}" if BOT_NAME else name
+    _maintenance_jobs.append(name)
+    MAINTENANCE.every(name, interval, fn)
+
+def updates_total():
+    return _updates_seen
+
+def rotate_logs():
+    """bot_events.log и bot_errors.log больше LOG_MAX_BYTES уходят в .1 (одна старая копия)"""
+    for path in (EVENT_LOG, ERROR_LOG):
+        try:
+            if os.path.getsize(path) > LOG_MAX_BYTES:
+                os.replace(path, path + ".1")
+        except OSError:
+            pass
+
+def start_maintenance():
+    """Периодическая работа процесса — по таймерам, а не по счётчикам запросов"""
+    if HAS_ANCHOR:
+        maintain("anchor_flush", AUTOSAVE_INTERVAL, anchor.autosave)
+        maintain("anchor_gc", GC_INTERVAL, anchor.gc)
+        maintain("wal_compact", COMPACT_INTERVAL, anchor.backend.maybe_compact)
+    if RESULT_CACHE:
+        maintain("result_cache_ttl", RESULT_CACHE_EXPIRE_INTERVAL, RESULT_CACHE.expire)
+    maintain("summary", SUMMARY_INTERVAL, lambda: save_summary(updates_total()))
+    if not SHARD:
+        maintain("log_rotate", COMPACT_INTERVAL, rotate_logs)
+    MAINTENANCE.start()
+
+# ---------------------------
+# Shutdown & handoff
+# ---------------------------
+# Деплой без паузы: новый экземпляр прогревается (каталог, якорь, пулы — при
+# импорте), затем шлёт SIGTERM старому и ждёт, пока тот отпустит getUpdates.
+# Старый дорабатывает текущую пачку, сдаёт offset, отпускает приём и только
+# потом дожидается фоновых задач и пишет всё на диск. Оба экземпляра должны
+# видеть один DATA_DIR (PROMPTBINDER_DATA).
+DRAIN_TIMEOUT = getattr(config, "DRAIN_TIMEOUT", 20)
+HANDOFF_TIMEOUT = getattr(config, "HANDOFF_TIMEOUT", DRAIN_TIMEOUT)
+POLL_LOCK = os.path.join(DATA_DIR, "polling.pid")
+
+def request_stop(signum=None, frame=None):
+    """SIGTERM: приём прекращается после текущего getUpdates"""
+    if not STOPPING.is_set():
+        log_event(f"stop_requested signal={signum}")
+    STOPPING.set()
+
+def install_signal_handlers():
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, request_stop)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def take_over_polling():
+    """Просит предыдущий экземпляр отпустить getUpdates и ждёт его; затем записывает свой pid"""
+    try:
+        with open(POLL_LOCK, "r") as f:
+            pid = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        pid = 0
+    if pid and pid != os.getpid() and _pid_alive(pid):
+        t0 = time.monotonic()
+        log_event(f"handoff_request old_pid={pid}")
+        os.kill(pid, signal.SIGTERM)
+        while os.path.exists(POLL_LOCK) and _pid_alive(pid) and time.monotonic() - t0 < HANDOFF_TIMEOUT:
+            time.sleep(0.05)
+        log_event(f"handoff_done old_pid={pid} waited={time.monotonic() - t0:.2f}s")
+    with open(POLL_LOCK, "w") as f:
+        f.write(str(os.getpid()))
+
+def release_polling(offset):
+    """Сдаёт offset (backend и сам Telegram) и отпускает приём следующему экземпляру"""
+    if HAS_ANCHOR:
+        anchor.set_offset(offset)
+        # до снятия pid-файла: преемник читает сессии из базы, и незаконченные анкеты должны быть там
+        anchor.save_history()
+    try:
+        # timeout=0: подтверждает offset в Telegram, полученное не трогаем — оно для преемника
+        _get_updates(offset, 0)
+    except Exception as e:
+        log_error(f"offset confirm error: {e}")
+    try:
+        with open(POLL_LOCK, "r") as f:
+            mine = f.read().strip() == str(os.getpid())
+        if mine:
+            os.remove(POLL_LOCK)
+    except OSError:
+        pass
+    log_event(f"polling_released offset={offset}")
+
+def shutdown():
+    """Дожидается фоновых задач до DRAIN_TIMEOUT и сбрасывает буферы на диск"""
+    t0 = time.monotonic()
+    left = lambda: max(0.0, DRAIN_TIMEOUT - (time.monotonic() - t0))
+    if TENANT:
+        for name in _maintenance_jobs:  # общий планировщик и пулы останавливает tenancy.py
+            MAINTENANCE.cancel(name)
+    else:
+        MAINTENANCE.stop()
+    if BROADCAST and BROADCAST.stop(keep=True):
+        BROADCAST.join(left())  # чекпоинт остаётся running — продолжит следующий экземпляр
+    drained = all(q.drain(left()) for q in (GEN_QUEUE, BULK_QUEUE) if q)
+    if not TENANT:
+        _ack_pool.shutdown(wait=True)
+    if PENDING_SENDS and BREAKER.state == breaker.CLOSED:
+        flush_pending()
+    if HAS_ANCHOR:
+        anchor.save_history()
+    save_summary(updates_total())
+    log_event(f"shutdown_complete drained={drained} took={time.monotonic() - t0:.2f}s "
+              f"pending_sends={len(PENDING_SENDS)}")
 
 # ---------------------------
 # Polling loop
 # ---------------------------
-def polling():
-    offset = 0
+def polling(dispatch=handle_update):
+    install_signal_handlers()
+    take_over_polling()  # до чтения offset: его сдаёт предыдущий экземпляр
+    # offset хранится в backend якоря и переживает перезапуск
+    offset = anchor.get_offset() if HAS_ANCHOR else 0
     last_ok = time.time()
-    req_counter = 0
     log_event("polling_start_with_context_anchor")
     logger.warning("PromptBinder (variant C with Context Anchor) starting")
     
     if HAS_ANCHOR:
         log_event(f"Context anchor loaded: {anchor.get_chat_summary()}")
+    start_maintenance()
+    start_metrics()
+    resume_broadcast()
     
-    while True:
+    while not STOPPING.is_set():
         try:
-            r = requests.get(URL + "getUpdates", params={"offset": offset, "timeout": 20, "allowed_updates": ["message","callback_query"]}, timeout=30)
-            req_counter += 1
+            if GOVERNOR.evaluate() >= overload.PAUSE_INTAKE:
+                # приём на паузе: Telegram подержит апдейты у себя
+                last_ok = time.time()
+                STOPPING.wait(1)
+                continue
+            r = get_updates(offset)
+            if r is None:
+                # цепь открыта: не ждём таймаутов, пробуем снова после паузы
+                last_ok = time.time()
+                STOPPING.wait(1)
+                continue
             if r.status_code != 200:
                 log_error(f"getUpdates status {r.status_code}")
-                time.sleep(2)
+                STOPPING.wait(2)
                 continue
             data = r.json()
             if not data.get("ok"):
                 log_error(f"getUpdates ok=false: {data}")
-                time.sleep(2); continue
+                STOPPING.wait(2); continue
             results = data.get("result", [])
             if results:
                 last_ok = time.time()
             for upd in results:
                 offset = upd["update_id"] + 1
-                if "message" in upd:
-                    m = upd["message"]
-                    chat_id = m.get("chat", {}).get("id")
-                    text = m.get("text","")
-                    try:
-                        process_text(chat_id, text)
-                    except Exception as e:
-                        log_error(f"process_text error: {e}\n{traceback.format_exc()}")
-                elif "callback_query" in upd:
-                    try:
-                        process_callback(upd["callback_query"])
-                    except Exception as e:
-                        log_error(f"callback error: {e}\n{traceback.format_exc()}")
+                if dispatch is not handle_update:
+                    count_update()  # приёмник sharding.py: в summary.json — все принятые апдейты
+                dispatch(upd)
+            if results and HAS_ANCHOR:
+                anchor.set_offset(offset)
             
             # anti-freeze
             if time.time() - last_ok > 120:
-                save_summary(req_counter)
+                save_summary(updates_total())
                 log_error("No updates >120s — restarting polling")
                 raise Exception("poll_freeze")
             
-            if req_counter >= 100:
-                save_summary(req_counter)
-                req_counter = 0
-            
-            # Периодическое сохранение контекста
-            if HAS_ANCHOR and req_counter % 50 == 0:
-                anchor.save_history()
-            
-            time.sleep(0.25)
+            # лаг цикла: насколько позже положенного мы проснулись
+            t0 = time.perf_counter()
+            if not STOPPING.wait(0.25):
+                LOOP_LAG.set(max(0.0, time.perf_counter() - t0 - 0.25))
         except KeyboardInterrupt:
             log_event("stopped_by_keyboard")
-            if HAS_ANCHOR:
-                anchor.save_history()
             break
         except Exception as e:
             log_error(f"poll loop error: {e}\n{traceback.format_exc()}")
-            time.sleep(5)
+            STOPPING.wait(5)
             continue
     
+    release_polling(offset)
+    shutdown()
     log_event("polling_end")
 
+# ---------------------------
+# Webhook
+# ---------------------------
+# Несколько процессов за балансировщиком: STATE_BACKEND = "shared:/path/state.db"
+# в config.py, чтобы сессии и dedup были общими. Только на одной машине:
+# sqlite в режиме WAL не работает через сеть (NFS и т.п.), см. state_backend.py.
+def serve_webhook(port):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    secret = getattr(config, "WEBHOOK_SECRET", None)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/webhook":
+                self.send_response(404); self.end_headers(); return
+            if secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                self.send_response(403); self.end_headers(); return
+            try:
+                n = int(self.headers.get("Content-Length") or 0)
+                upd = json.loads(self.rfile.read(n) or b"{}")
+            except Exception as e:
+                log_error(f"webhook parse error: {e}")
+                self.send_response(400); self.end_headers(); return
+            handle_update(upd)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b'{"ok":true}')
+
+        def log_message(self, *args):
+            pass
+
+    start_maintenance()
+    start_metrics()
+    log_event(f"webhook_start port={port} pid={os.getpid()}")
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = False  # server_close() дожидается запросов в работе
+    # SIGTERM: перестаём принимать, запросы в работе дорабатывают, затем shutdown()
+    signal.signal(signal.SIGTERM, lambda *a: threading.Thread(target=server.shutdown, daemon=True).start())
+    server.serve_forever()
+    server.server_close()
+    shutdown()
+
 # ---------------------------
 # Run
 # ---------------------------
@@ -660,4 +1494,7 @@ if __name__ == "__main__":
     else:
         logger.warning("Running WITHOUT context anchor (duplication protection disabled)")
     
-    polling()
+    if os.environ.get("BOT_MODE") == "webhook":
+        serve_webhook(int(os.environ.get("PORT", 8080)))
+    else:
+        polling()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — circuit breaker for the Bot API client
+After FAILURE_THRESHOLD failures in a row the circuit opens and calls fail
+at once instead of waiting out their timeouts. After RESET_TIMEOUT one
+probe call is let through (half-open); success closes the circuit,
+failure opens it again.
+"""
+
+import time
+import threading
+
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 5.0
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.listeners = []  # fn(state) при смене состояния
+        self._lock = threading.Lock()
+
+    def on_change(self, fn):
+        self.listeners.append(fn)
+
+    def allow(self):
+        """Можно ли сейчас звать API; в half-open пропускает одну пробу"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                changed = self._set(HALF_OPEN)
+            else:
+                changed = None
+            if self.probing:
+                allowed = False
+            else:
+                self.probing = allowed = True
+        self._notify(changed)
+        return allowed
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            changed = self._set(CLOSED)
+        self._notify(changed)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            changed = None
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                changed = self._set(OPEN)
+        self._notify(changed)
+
+    def _set(self, state):
+        if state == self.state:
+            return None
+        self.state = state
+        return state
+
+    def _notify(self, state):
+        if state is None:
+            return
+        for fn in self.listeners:
+            try:
+                fn(state)
+            except Exception:
+                pass
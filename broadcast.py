@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — admin broadcast to every known chat
+Recipients are read from the state backend page by page (keyset on
+user_id), so the list is never held in memory. Sends go through a few
+lanes that share one per-bot budget with interactive replies: replies take
+from it without waiting, the broadcast only gets what is left, so at the
+Telegram limit of ~30 messages/s a broadcast to N chats takes about N / 30
+seconds and users still get answers.
+
+The budget is per process. Sharded workers (sharding.py) each get an
+equal slice of the bot's rate, so a broadcast from one worker and replies
+from the others stay under the limit together; the broadcast then runs at
+that slice.
+
+Progress is checkpointed in the backend meta after every page: after a
+crash the last unfinished page is sent again, after /broadcast stop only
+the few sends that were in flight are.
+Chats that blocked the bot (403) are marked inactive and skipped until
+they write again.
+When the Bot API is unavailable (circuit open, network error, 5xx) the page
+is cut at the first such chat, like on stop: the cursor never moves past
+it, and the broadcast waits for the API with backoff instead of counting
+those chats as failed. Sends of later lanes that were already in flight may
+be repeated once.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+GLOBAL_RATE = 30.0   # сообщений в секунду на бота — общий лимит Telegram
+LANES = 8            # параллельных отправок: RTT не должен ограничивать темп
+BATCH = 300          # получателей на страницу и на чекпоинт: ~10 с отправок на лимите
+MAX_ATTEMPTS = 5     # попыток на чат при 429; сбой API попыткой не считается
+OUTAGE_WAIT = 2.0    # первая пауза при недоступном API, дальше вдвое
+OUTAGE_WAIT_MAX = 60.0
+CHECKPOINT_KEY = "broadcast"
+
+SENT, BLOCKED, FAILED, RETRY, UNAVAILABLE = "sent", "blocked", "failed", "retry", "unavailable"
+
+class SendBudget:
+    """Токены отправки бота: take() — интерактив, без ожидания; acquire() — рассылка, ждёт"""
+
+    def __init__(self, rate=GLOBAL_RATE, clock=time.monotonic):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.clock = clock
+        self.last = clock()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        """Интерактивная отправка: не ждёт, но уменьшает долю рассылки (баланс может уйти в минус)"""
+        with self._lock:
+            self._refill(self.clock())
+            self.tokens = max(-self.rate, self.tokens - 1.0)
+
+    def acquire(self, stop=None):
+        """Ждёт токен; False — рассылку остановили"""
+        while stop is None or not stop.is_set():
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait = max(self.paused_until - now, (1.0 - self.tokens) / self.rate)
+            time.sleep(min(max(wait, 0.005), 0.5))
+        return False
+
+    def pause(self, seconds):
+        """429 от Telegram: все полосы рассылки молчат retry_after секунд"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+class Broadcast:
+    """Одна рассылка за раз; состояние — dict, который и есть чекпоинт"""
+
+    def __init__(self, backend, send, budget, lanes=LANES, batch=BATCH, on_done=None, log=print):
+        self.backend = backend
+        self.send = send        # send(chat_id, text) -> (SENT|BLOCKED|FAILED|RETRY|UNAVAILABLE, retry_after)
+        self.budget = budget
+        self.lanes = lanes
+        self.batch = batch
+        self.on_done = on_done or (lambda state: None)
+        self.log = log
+        self.state = backend.get_meta(CHECKPOINT_KEY)
+        self._stop = threading.Event()
+        self._outage = threading.Event()  # одна полоса увидела сбой API — остальные не шлют
+        self._keep = False
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text, admin=None):
+        """False — уже идёт другая рассылка"""
+        if self.running():
+            return False
+        self.state = {"id": int(time.time()), "text": text, "admin": admin, "after": "",
+                      "sent": 0, "blocked": 0, "failed": 0, "status": "running",
+                      "started": time.time(), "finished": None}
+        self._checkpoint()
+        self._launch()
+        return True
+
+    def resume(self):
+        """Продолжает прерванную рассылку из чекпоинта; False — продолжать нечего"""
+        if self.running() or not self.state or self.state.get("status") not in ("running", "stopped"):
+            return False
+        self.state.update(status="running", finished=None)
+        self._launch()
+        return True
+
+    def stop(self, keep=False):
+        """keep=True — остановка процесса: чекпоинт остаётся running и продолжится при старте"""
+        if not self.running():
+            return False
+        self._keep = keep
+        self._stop.set()
+        return True
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _launch(self):
+        self._stop.clear()
+        self._keep = False
+        self._thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self._thread.start()
+
+    def _checkpoint(self):
+        self.backend.save({}, {CHECKPOINT_KEY: self.state})
+
+    def _run(self):
+        st = self.state
+        self.log(f"broadcast_{st['id']} from={st['after'] or 'start'}")
+        wait = OUTAGE_WAIT
+        with ThreadPoolExecutor(self.lanes, thread_name_prefix="broadcast-lane") as pool:
+            while not self._stop.is_set():
+                ids = self.backend.recipients(st["after"], self.batch)
+                if not ids:
+                    st["status"] = "done"
+                    break
+                self._outage.clear()
+                results = list(pool.map(lambda uid: self._deliver(uid, st["text"]), ids))
+                cut = next((i for i, res in enumerate(results) if res is None or res == UNAVAILABLE), None)
+                outage = cut is not None and results[cut] == UNAVAILABLE
+                if cut is not None:
+                    # остановка или сбой API посреди страницы: фиксируем доставленный префикс,
+                    # курсор за недоставленных не уходит
+                    ids, results = ids[:cut], results[:cut]
+                if ids:
+                    self._commit(st, ids, results)
+                if outage:
+                    self.log(f"broadcast_{st['id']} api unavailable after={st['after'] or 'start'}, waiting {wait:.0f}s")
+                    self._stop.wait(wait)
+                    wait = min(wait * 2, OUTAGE_WAIT_MAX)
+                    continue
+                wait = OUTAGE_WAIT
+                if not ids:
+                    break
+        if st["status"] == "running" and not self._keep:
+            st["status"] = "stopped"
+        if st["status"] != "running":
+            st["finished"] = time.time()
+        self._checkpoint()
+        self.log(f"broadcast_{st['id']} {st['status']} sent={st['sent']} blocked={st['blocked']} failed={st['failed']}")
+        if st["status"] != "running":
+            self.on_done(st)
+
+    def _commit(self, st, ids, results):
+        """Доставленный префикс страницы: счётчики, заблокировавшие, курсор и чекпоинт"""
+        blocked = [uid for uid, res in zip(ids, results) if res == BLOCKED]
+        if blocked:
+            self.backend.mark_inactive(blocked)
+        for res in results:
+            st[res] = st.get(res, 0) + 1
+        st["after"] = ids[-1]
+        self._checkpoint()
+
+    def _deliver(self, uid, text):
+        """Результат доставки; None — рассылку остановили"""
+        chat_id = int(uid) if uid.lstrip("-").isdigit() else uid
+        for _ in range(MAX_ATTEMPTS):
+            if self._outage.is_set():
+                return UNAVAILABLE
+            if not self.budget.acquire(self._stop):
+                return None
+            result, retry_after = self.send(chat_id, text)
+            if result == UNAVAILABLE:
+                self._outage.set()
+            if result != RETRY:
+                return result
+            self.budget.pause(retry_after or 1.0)
+        return FAILED
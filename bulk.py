@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — bulk rendering of one template over a CSV/JSONL file
+Rows are streamed from the input file and written to a gzip JSONL output,
+one {"row": n, "fields": {...}, "prompt": "..."} line per row, so memory
+use does not depend on the file size.
+"""
+
+import csv
+import gzip
+import json
+import time
+
+from catalog import render
+
+BATCH = 500               # строк между проверками прогресса
+PROGRESS_INTERVAL = 2.0   # секунд между сообщениями о прогрессе
+MAX_ROWS = 100000
+
+class BulkError(Exception):
+    pass
+
+def detect_kind(path, file_name=""):
+    """'jsonl' или 'csv' по расширению, иначе по первому непробельному символу"""
+    name = (file_name or "").lower()
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    if name.endswith((".csv", ".tsv", ".txt")):
+        return "csv"
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        head = f.read(256).lstrip()
+    return "jsonl" if head.startswith("{") else "csv"
+
+def iter_rows(path, kind):
+    """Строки файла как dict поле -> значение, по одной"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if kind == "jsonl":
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    raise BulkError(f"строка {n}: не JSON")
+                if not isinstance(row, dict):
+                    raise BulkError(f"строка {n}: ожидается объект {{\"поле\": \"значение\"}}")
+                yield {str(k).strip(): "" if v is None else str(v) for k, v in row.items()}
+        else:
+            sample = f.read(4096)
+            f.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            try:
+                for row in csv.DictReader(f, dialect=dialect):
+                    yield {k.strip(): (v or "") for k, v in row.items() if k is not None}  # лишние колонки строки — мимо
+            except csv.Error as e:
+                raise BulkError(f"CSV: {e}")
+
+def render_file(in_path, out_path, parts, kind, progress=None, max_rows=MAX_ROWS):
+    """Рендерит каждую строку шаблоном parts в gzip JSONL; progress(n) — не чаще PROGRESS_INTERVAL"""
+    n = 0
+    last = time.monotonic()
+    with gzip.open(out_path, "wt", encoding="utf-8", compresslevel=6) as out:
+        for row in iter_rows(in_path, kind):
+            n += 1
+            if n > max_rows:
+                raise BulkError(f"больше {max_rows} строк")
+            out.write(json.dumps({"row": n, "fields": row, "prompt": render(parts, row)}, ensure_ascii=False) + "\n")
+            if progress and n % BATCH == 0 and time.monotonic() - last >= PROGRESS_INTERVAL:
+                progress(n)
+                last = time.monotonic()
+    return n
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — compiled prompt catalog
+prompts.json is compiled once into catalog.cache: category buttons,
+keyboards, a text -> action routing index and pre-split templates.
+The cache is stamped with CATALOG_VERSION and a hash of prompts.json,
+so it is rebuilt only when either changes.
+"""
+
+import os
+import re
+import json
+import pickle
+import hashlib
+
+CATALOG_VERSION = 5
+MAX_CATEGORIES = 6
+MAX_ITEMS = 6
+
+# скомпилированные каталоги процесса по (путь, stamp): боты с одним prompts.json делят один объект
+_LOADED = {}
+
+# ---------------------------
+# Icon maps
+# ---------------------------
+PROMPT_ICONS = {
+    "idea": "💡",
+    "tagline": "✍️",
+    "ad": "📢",
+    "product": "📦",
+    "script": "🎞️",
+    "context": "💬",
+    "analysis": "📊",
+    "news": "📰",
+    "email": "✉️",
+    "structure": "🧱"
+}
+
+CATEGORY_DESC = {
+    "creative": "идеи, слоганы",
+    "marketing": "реклама, офферы",
+    "video": "сценарии, ролики",
+    "content": "посты, упрощение",
+    "crypto": "монеты, новости",
+    "work": "письма, структура"
+}
+
+# ---------------------------
+# Helpers re icons / cleaning
+# ---------------------------
+def starts_with_icon(s, icon):
+    if not s or not icon:
+        return False
+    s = s.strip()
+    return s.startswith(icon) or s.startswith(icon + " ")
+
+def strip_leading_icon(s):
+    if not s:
+        return s
+    s = s.strip()
+    if len(s) >= 2 and (not s[0].isalnum()) and s[1] == " ":
+        return s[2:].strip()
+    return s
+
+def item_button(key, p):
+    title = strip_leading_icon(p.get("title", "")) or ""
+    icon_right = PROMPT_ICONS.get(key, "")
+    return f"{title}{'  ' + icon_right if icon_right else ''}"
+
+# ---------------------------
+# Templates
+# ---------------------------
+FIELD_RE = re.compile(r"\{([^}]+)\}")
+
+def compile_template(template):
+    """'a {x} b' -> ('a ', 'x', ' b'): чётные элементы — текст, нечётные — поля"""
+    return tuple(FIELD_RE.split(template or ""))
+
+def render(parts, data):
+    """Подставляет значения полей; незаполненные поля пропадают, как и раньше"""
+    out = []
+    for i, part in enumerate(parts):
+        out.append(data.get(part, "") if i % 2 else part)
+    return "".join(out)
+
+# ---------------------------
+# One-shot forms
+# ---------------------------
+FORM_LINE_RE = re.compile(r"^\s*([^:=\n]+?)\s*[:=]\s*(.*?)\s*$")
+
+def compile_form(p):
+    """Бланк для ответа одним сообщением: 'поле: пример' по строке на поле"""
+    fields = p.get("fields", []) or []
+    examples = p.get("fields_examples", {}) or {}
+    return "\n".join(f"{f}: {examples.get(f, '')}".rstrip() for f in fields)
+
+def parse_form(text, fields):
+    """Значения нескольких полей из одного сообщения или None, если это ответ на одно поле.
+
+    Только строки 'поле: значение' (в любом порядке, можно не все) — как в бланке.
+    Остальной многострочный текст — значение текущего поля целиком."""
+    if ":" not in (text or "") and "=" not in (text or ""):
+        return None
+    by_name = {f.lower(): f for f in fields}
+    keyed = {}
+    for line in text.splitlines():
+        m = FORM_LINE_RE.match(line)
+        if m and m.group(1).lower() in by_name and m.group(2):
+            keyed[by_name[m.group(1).lower()]] = m.group(2)
+    return keyed or None
+
+# ---------------------------
+# Callback data
+# ---------------------------
+# callback_data = <тег каталога><действие><номер>[.<страница>], например "3f2c1.1";
+# разбирается одним поиском в таблице callbacks -> (action, category_id, prompt_key, page).
+# Тег зависит от prompts.json: после правки каталога кнопки старых сообщений
+# не попадут в чужой промпт, а распознаются как устаревшие (нет в таблице).
+CB_HOME, CB_HELP, CB_COPY, CB_CATEGORY, CB_PROMPT, CB_RUN = "home", "help", "copy", "category", "prompt", "run"
+PAGE_SIZE = MAX_ITEMS
+
+def catalog_tag(raw):
+    data = json.dumps(raw, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=2).hexdigest()[:3]
+
+def _inline_keyboards(raw, categories, prompts):
+    """Inline-клавиатуры с кодированными callback_data и таблица их разбора"""
+    tag = catalog_tag(raw)
+    callbacks = {}
+
+    def code(data, action, cat=None, key=None, page=0):
+        callbacks[tag + data] = (action, cat, key, page)
+        return tag + data
+
+    home, help_, copy = code("h", CB_HOME), code("?", CB_HELP), code("x", CB_COPY)
+    run = {"text": "▶️ Запустить", "callback_data": code("r", CB_RUN)}
+    prompt_code = {key: code(f"p{i}", CB_PROMPT, key=key) for i, key in enumerate(prompts)}
+    # данные кнопок, разосланных до кодирования, — чтобы старые сообщения работали
+    callbacks.update({"copy_prompt": (CB_COPY, None, None, 0), "home": (CB_HOME, None, None, 0),
+                      "help": (CB_HELP, None, None, 0)})
+    callbacks.update({f"p:{key}": (CB_PROMPT, None, key, 0) for key in prompts})
+
+    cat_rows, ikb_items = [], {}
+    for ci, c in enumerate(categories):
+        callbacks[f"c:{c['id']}"] = (CB_CATEGORY, c["id"], None, 0)
+        keys = [k for k in c.get("items", []) if prompts.get(k)]
+        npages = max(1, -(-len(keys) // PAGE_SIZE))
+        page_code = [code(f"c{ci}" + (f".{n}" if n else ""), CB_CATEGORY, c["id"], page=n) for n in range(npages)]
+        cat_rows.append([{"text": c["button"], "callback_data": page_code[0]}])
+        pages = []
+        for n in range(npages):
+            chunk = keys[n * PAGE_SIZE:(n + 1) * PAGE_SIZE]
+            rows = [[{"text": item_button(k, prompts[k]), "callback_data": prompt_code[k]} for k in chunk[i:i + 2]]
+                    for i in range(0, len(chunk), 2)]
+            nav = []
+            if n > 0:
+                nav.append({"text": "◀️", "callback_data": page_code[n - 1]})
+            if n < npages - 1:
+                nav.append({"text": "▶️", "callback_data": page_code[n + 1]})
+            if nav:
+                rows.append(nav)
+            rows.append([{"text": "⬅️ Назад", "callback_data": home}])
+            pages.append({"inline_keyboard": rows})
+        ikb_items[c["id"]] = pages
+
+    ikb_cats = {"inline_keyboard": cat_rows + [[{"text": "❓ Что может бот", "callback_data": help_}]]}
+    ikb_result = {"inline_keyboard": [[{"text": "📋 Скопировать промпт", "callback_data": copy}]] + cat_rows}
+    ikb_cancel = {"inline_keyboard": [[{"text": "❌ Отмена", "callback_data": home}]]}
+    return {"ikb_categories": ikb_cats, "ikb_items": ikb_items, "ikb_result": ikb_result,
+            "ikb_cancel": ikb_cancel, "ikb_run": run, "callbacks": callbacks}
+
+# ---------------------------
+# Compile
+# ---------------------------
+
+def compile_catalog(raw):
+    categories = [dict(c) for c in raw.get("categories", [])[:MAX_CATEGORIES]]
+    prompts = raw.get("prompts", {})
+    while len(categories) < MAX_CATEGORIES:
+        categories.append({"id": f"more{len(categories)+1}", "title": "Другие", "icon": "➕", "items": []})
+
+    for c in categories:
+        icon = (c.get("icon") or "").strip()
+        title = (c.get("title") or "").strip()
+        title_clean = strip_leading_icon(title)
+        desc = CATEGORY_DESC.get(c.get("id", ""), "").strip()
+        if icon and not starts_with_icon(title, icon):
+            base = f"{icon} {title_clean}"
+        else:
+            base = title_clean
+        c["button"] = f"{base} — {desc}" if desc else base
+
+    kb_cats = {"keyboard": [[{"text": c["button"]}] for c in categories],
+               "resize_keyboard": True, "one_time_keyboard": False}
+    kb_cats["keyboard"].append([{"text": "❓ Что может бот"}])
+
+    kb_items = {}
+    for c in categories:
+        kb = {"keyboard": [], "resize_keyboard": True, "one_time_keyboard": False}
+        row = []
+        for key in c.get("items", [])[:MAX_ITEMS]:
+            p = prompts.get(key)
+            if not p:
+                continue
+            row.append({"text": item_button(key, p)})
+            if len(row) == 2:
+                kb["keyboard"].append(row)
+                row = []
+        if row:
+            kb["keyboard"].append(row)
+        kb["keyboard"].append([{"text": "⬅️ Назад"}, {"text": "🏠 Домой"}])
+        kb_items[c["id"]] = kb
+
+    # маршруты: порядок совпадает со старыми циклами в process_text —
+    # категории важнее промптов, среди промптов побеждает первый
+    routes, routes_lower = {}, {}
+    for key, p in prompts.items():
+        title_clean = strip_leading_icon(p.get("title", "")) or ""
+        routes.setdefault(item_button(key, p), ("prompt", key))
+        routes.setdefault(title_clean, ("prompt", key))
+        routes_lower.setdefault(title_clean.lower(), key)
+    for c in reversed(categories):
+        routes[c["title"]] = ("category", c["id"])
+        routes[c["button"]] = ("category", c["id"])
+
+    compiled = {
+        "categories": categories,
+        "prompts": prompts,
+        "kb_categories": kb_cats,
+        "kb_items": kb_items,
+        "routes": routes,
+        "routes_lower": routes_lower,
+        "templates": {key: compile_template(p.get("template", "")) for key, p in prompts.items()},
+        "forms": {key: compile_form(p) for key, p in prompts.items()},
+    }
+    compiled.update(_inline_keyboards(raw, categories, prompts))
+    return compiled
+
+# ---------------------------
+# Load with cache
+# ---------------------------
+def _stamp(data):
+    return (CATALOG_VERSION, hashlib.blake2b(data, digest_size=16).hexdigest())
+
+def load_catalog(prompts_file, cache_file, sample, log_event=None, log_error=None):
+    """Скомпилированный каталог; prompts.json пересобирается, только если изменился"""
+    log_event = log_event or (lambda msg: None)
+    log_error = log_error or (lambda msg: None)
+    try:
+        with open(prompts_file, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = None
+
+    if data is not None:
+        stamp = _stamp(data)
+        memo_key = (os.path.abspath(prompts_file), stamp)
+        if memo_key in _LOADED:
+            return _LOADED[memo_key]
+        try:
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if cached.get("stamp") == stamp:
+                _LOADED[memo_key] = cached
+                return cached
+        except Exception:
+            pass
+        try:
+            raw = json.loads(data.decode("utf-8"))
+        except Exception as e:
+            log_error(f"prompts.json parse error: {e} — recreating sample")
+            raw = None
+    else:
+        raw = None
+        log_event("prompts.json not found → sample created")
+
+    if raw is None:
+        raw = sample
+        data = json.dumps(sample, ensure_ascii=False, indent=2).encode("utf-8")
+        try:
+            with open(prompts_file, "wb") as f:
+                f.write(data)
+        except Exception as e:
+            log_error(f"cannot write prompts.json: {e}")
+
+    compiled = compile_catalog(raw)
+    compiled["stamp"] = _stamp(data)
+    try:
+        tmp = cache_file + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except Exception as e:
+        log_error(f"catalog cache write error: {e}")
+    log_event(f"catalog compiled v{CATALOG_VERSION}: {len(compiled['prompts'])} prompts")
+    _LOADED[(os.path.abspath(prompts_file), compiled["stamp"])] = compiled
+    return compiled
@@ -12,125 +12,478 @@
 Текущий статус: Бот работает на Bothost, использует bot_pro.py (polling)
 """
 
+import sys
 import time
+import atexit
 import json
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
+from state_backend import content_hash, make_backend, DEDUP_TTL
+from metrics import FLUSH_SECONDS
+from tracing import span
+
+try:
+    import config
+except Exception:
+    config = None
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get("PROMPTBINDER_DATA", BASE)
+os.makedirs(DATA_DIR, exist_ok=True)
+HISTORY_DB = os.path.join(DATA_DIR, "chat_history.db")
+LEGACY_HISTORY_FILE = os.path.join(DATA_DIR, "chat_history.json")
+
+# окно "активных сессий" и шаг индекса активности
+ACTIVE_WINDOW = 3600
+ACTIVITY_BUCKET = 60
+
+# примерный размер одной резидентной сессии, ~550 Б по bench_sessions.py
+SESSION_BYTES = 600
+
+# незавершённые формы старше этого срока удаляются
+FLOW_TTL = 7 * 24 * 3600
+AUTOSAVE_INTERVAL = 5
+GC_INTERVAL = 3600
+MAX_SAVE_DEFER = 60  # при перегрузке запись откладывается, но не дольше
+
+# ---------------------------
+# Компактная сессия
+# ---------------------------
+_FIELDS = {}  # общий кэш кортежей полей: одинаковые формы делят один объект
+
+def _intern(v):
+    return sys.intern(v) if type(v) is str else v
+
+def _intern_flow(flow):
+    if not flow:
+        return flow
+    fields = tuple(_intern(f) for f in flow.get('fields', ()))
+    flow['fields'] = _FIELDS.setdefault(fields, fields)
+    flow['state'] = _intern(flow.get('state'))
+    flow['prompt_key'] = _intern(flow.get('prompt_key'))
+    flow['data'] = {_intern(k): v for k, v in (flow.get('data') or {}).items()}
+    return flow
+
+def _ts(v):
+    """Время как число; старые записи хранили ISO-строки"""
+    if isinstance(v, str):
+        try:
+            return datetime.fromisoformat(v).timestamp()
+        except ValueError:
+            return 0.0
+    return float(v or 0)
+
+class Session:
+    """Состояние одного чата: слоты вместо dict, числовые метки времени, общие строки ключей"""
+    __slots__ = ('last_action', 'created_at', 'current_category', 'current_prompt',
+                 'message_count', 'last_message', 'flow', 'stats', 'extra')
+
+    def __init__(self, now=None):
+        now = time.time() if now is None else now
+        self.last_action = now
+        self.created_at = now
+        self.current_category = None
+        self.current_prompt = None
+        self.message_count = 0
+        self.last_message = None
+        self.flow = None
+        self.stats = None
+        self.extra = None
+
+    # dict-подобный доступ, чтобы старый код (state.get('message_count')) работал как раньше
+    def get(self, key, default=None):
+        if key in Session.__slots__:
+            v = getattr(self, key)
+        else:
+            v = (self.extra or {}).get(key)
+        return default if v is None else v
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def update(self, values):
+        for k, v in values.items():
+            if k == 'flow':
+                self.flow = _intern_flow(v)
+            elif k in ('current_category', 'current_prompt'):
+                setattr(self, k, _intern(v))
+            elif k in Session.__slots__:
+                setattr(self, k, v)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[k] = v
+
+    def to_dict(self):
+        d = {k: getattr(self, k) for k in Session.__slots__ if k != 'extra'}
+        if self.extra:
+            d.update(self.extra)
+        return {k: v for k, v in d.items() if v is not None}
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls(now=_ts(d.get('last_action')))
+        s.created_at = _ts(d.get('created_at', s.last_action))
+        s.message_count = d.get('message_count', 0)
+        stats = d.get('stats')
+        if stats:
+            stats = dict(stats)
+            stats['last_session'] = _ts(stats.get('last_session'))
+        s.stats = stats
+        rest = {k: v for k, v in d.items()
+                if k not in ('last_action', 'created_at', 'message_count', 'stats', 'last_keyboard')}
+        s.update(rest)
+        return s
+
+# ---------------------------
+# Якорь
+# ---------------------------
 class ChatHistory:
     """Хранит историю взаимодействий с пользователем"""
     
-    def __init__(self):
-        self.history_file = "chat_history.json"
-        self.user_states = {}
-        self.message_tracker = {}
+    def __init__(self, backend=None, max_resident=None):
+        self.backend = backend or make_backend("sqlite", HISTORY_DB)
+        # общий backend: другие процессы меняют сессии, поэтому кэш не держим
+        self.shared = self.backend.shared
+        self.history_file = LEGACY_HISTORY_FILE
+        self.max_resident = max_resident  # None — все сессии в памяти
+        self.user_states = OrderedDict()  # резидентные сессии, от холодных к горячим
+        self.dirty = set()
+        self.total_users = 0
+        self.total_messages = 0
+        self.activity = {}  # минутный бакет -> число пользователей с last_action в нём
+        self.evicted = 0
+        self.defer_saves = False  # включается при перегрузке (overload.py)
+        self._last_save = time.time()
+        self._lock = threading.RLock()
         self.load_history()
     
+    def set_memory_budget(self, megabytes):
+        """Ограничивает память сессий; холодные сессии выгружаются на диск"""
+        if megabytes:
+            self.max_resident = max(1, int(megabytes * 1024 * 1024 / SESSION_BYTES))
+        else:
+            self.max_resident = None
+        with self._lock:
+            self._evict()
+    
     def load_history(self):
-        """Загружает историю из файла"""
-        if os.path.exists(self.history_file):
-            try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.user_states = data.get('user_states', {})
-                    self.message_tracker = data.get('message_tracker', {})
-            except:
-                self.user_states = {}
-                self.message_tracker = {}
+        """Поднимает счётчики; сами сессии читаются лениво, при первом обращении чата"""
+        with self._lock:
+            self.user_states = OrderedDict()
+            totals = self.backend.get_meta('totals')
+            if totals is None and os.path.exists(self.history_file):
+                self._import_legacy()
+            self._load_counters(totals)
     
-    def save_history(self):
-        """Сохраняет историю в файл"""
+    def _load_counters(self, totals=None):
+        """Счётчики из meta backend (или агрегатом, если их ещё нет); дальше — инкрементально.
+        meta:totals ведёт сам backend при каждой записи, общий для всех процессов с этим файлом"""
+        if totals is None:
+            totals = self.backend.totals()
+        self.total_users, self.total_messages = totals
+        self.activity = {}
+        for ts in self.backend.recent_activity(time.time() - ACTIVE_WINDOW):
+            self._touch(None, ts)
+    
+    def _decode(self, d):
+        s = Session.from_dict(d)
+        # устаревшая форма выгруженной сессии удаляется при подъёме
+        if s.flow and s.last_action < time.time() - FLOW_TTL:
+            s.flow = None
+        return s
+    
+    def _touch(self, old_ts, new_ts):
+        """Переносит пользователя из бакета old_ts в бакет new_ts индекса активности"""
+        if old_ts is not None:
+            old_b = int(old_ts // ACTIVITY_BUCKET)
+            n = self.activity.get(old_b)
+            if n is not None:
+                if n > 1:
+                    self.activity[old_b] = n - 1
+                else:
+                    del self.activity[old_b]
+        if time.time() - new_ts < ACTIVE_WINDOW:
+            new_b = int(new_ts // ACTIVITY_BUCKET)
+            self.activity[new_b] = self.activity.get(new_b, 0) + 1
+    
+    def active_sessions(self):
+        """Сессии за последний час: сумма не более чем ACTIVE_WINDOW / ACTIVITY_BUCKET бакетов"""
+        oldest = int((time.time() - ACTIVE_WINDOW) // ACTIVITY_BUCKET) + 1
+        for b in [b for b in self.activity if b < oldest]:
+            del self.activity[b]
+        return sum(self.activity.values())
+    
+    def _import_legacy(self):
         try:
-            data = {
-                'user_states': self.user_states,
-                'message_tracker': self.message_tracker,
-                'last_update': datetime.now().isoformat()
-            }
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except:
+            with open(self.history_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            sessions = {str(uid): Session.from_dict(state)
+                        for uid, state in data.get('user_states', {}).items()}
+            self.backend.save({uid: s.to_dict() for uid, s in sessions.items()})
+        except Exception:
             pass
     
-    def track_message(self, user_id, message_type, message_id=None):
-        """Отслеживает отправленное сообщение"""
-        key = f"{user_id}_{message_type}"
-        current_time = time.time()
-        
-        # Проверяем, не отправляли ли уже такое сообщение
-        if key in self.message_tracker:
-            last_time = self.message_tracker[key].get('timestamp', 0)
-            # Если прошло меньше 2 секунд - считаем дубликатом
-            if current_time - last_time < 2:
-                return False
-        
-        # Сохраняем новое сообщение
-        self.message_tracker[key] = {
-            'timestamp': current_time,
-            'message_id': message_id,
-            'type': message_type
-        }
-        
-        # Автосохранение каждые 10 записей
-        if len(self.message_tracker) % 10 == 0:
+    def _write(self, sessions):
+        """Upsert сессий; счётчики в meta backend обновляет той же транзакцией; sessions: {user_id: Session}"""
+        return self.backend.save({uid: s.to_dict() for uid, s in sessions.items()})
+    
+    @span("anchor.save_history")
+    def save_history(self):
+        """Записывает только изменённых с прошлого сохранения пользователей"""
+        with self._lock:
+            if not self.dirty:
+                return
+            batch = {uid: self.user_states[uid] for uid in self.dirty if uid in self.user_states}
+            with FLUSH_SECONDS.time(store="anchor"):
+                ok = self._write(batch)
+            if ok:
+                self.dirty.clear()
+                # всё записано: счётчики из базы учитывают и пользователей других воркеров
+                totals = self.backend.get_meta('totals')
+                if totals:
+                    self.total_users, self.total_messages = totals
+    
+    def _changed(self, user_id):
+        """Помечает сессию изменённой; с общим backend пишет сразу (write-through)"""
+        self.dirty.add(user_id)
+        if self.shared:
             self.save_history()
-        
+            self.user_states.pop(user_id, None)
+
+    def _forget(self, user_id):
+        """С общим backend прочитанная (и не изменённая) сессия в памяти не остаётся"""
+        if self.shared and self.user_states.pop(user_id, None) is not None:
+            self.dirty.discard(user_id)
+    
+    def _evict(self):
+        """Выгружает самые холодные сессии, пока не уложимся в бюджет"""
+        if self.max_resident is None or len(self.user_states) <= self.max_resident:
+            return
+        # выгружаем пачкой с запасом, чтобы не платить транзакцией за каждую вставку
+        n = len(self.user_states) - self.max_resident + max(1, self.max_resident // 10)
+        # самую свежую (только что запрошенную) сессию не трогаем
+        n = min(n, len(self.user_states) - 1)
+        victims = []
+        for uid in self.user_states:
+            if len(victims) >= n:
+                break
+            victims.append(uid)
+        batch = {uid: self.user_states[uid] for uid in victims if uid in self.dirty}
+        if batch and not self._write(batch):
+            return
+        for uid in victims:
+            del self.user_states[uid]
+            self.dirty.discard(uid)
+        self.evicted += len(victims)
+    
+    def _resident(self, user_id):
+        """Сессия из памяти или из backend; None, если пользователя нет"""
+        if self.shared:
+            # общий backend: сессию могли изменить другие воркеры — всегда свежая из базы
+            d = self.backend.load(user_id)
+            if d is None:
+                self.user_states.pop(user_id, None)
+                return None
+            s = self.user_states[user_id] = self._decode(d)
+            return s
+        s = self.user_states.get(user_id)
+        if s is not None:
+            self.user_states.move_to_end(user_id)
+            return s
+        if self.max_resident is None and self.total_users == len(self.user_states):
+            return None  # всё и так в памяти
+        d = self.backend.load(user_id)
+        if d is None:
+            return None
+        s = self.user_states[user_id] = self._decode(d)
+        self._evict()
+        return s
+    
+    def autosave(self):
+        """Шаг автосохранения; при перегрузке запись откладывается, но не дольше MAX_SAVE_DEFER"""
+        if self.defer_saves and time.time() - self._last_save < MAX_SAVE_DEFER:
+            return False
+        self.save_history()
+        self._last_save = time.time()
         return True
     
+    def gc(self):
+        """Устаревшие формы и протухшие ключи общей таблицы dedup"""
+        self.gc_stale_flows()
+        if hasattr(self.backend, 'expire_dedup'):
+            self.backend.expire_dedup()
+    
+    @span("anchor.get_flow")
+    def get_flow(self, user_id):
+        """Незавершённая форма пользователя (state, prompt_key, fields, index, data) или None"""
+        user_id = str(user_id)
+        with self._lock:
+            try:
+                s = self._resident(user_id)
+                return s.flow if s else None
+            finally:
+                self._forget(user_id)
+    
+    @span("anchor.set_flow")
+    def set_flow(self, user_id, flow):
+        """Сохраняет форму в сессии пользователя; на диск попадёт при следующем save_history"""
+        user_id = str(user_id)
+        with self._lock:
+            self._state(user_id).flow = _intern_flow(flow)
+            self._changed(user_id)
+    
+    def clear_flow(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            try:
+                s = self._resident(user_id)
+                if s and s.flow is not None:
+                    s.flow = None
+                    self._changed(user_id)
+            finally:
+                self._forget(user_id)
+    
+    def get_value(self, user_id, key):
+        """Произвольное поле сессии (menu_id, last_result, ...) без учёта как сообщения"""
+        user_id = str(user_id)
+        with self._lock:
+            try:
+                s = self._resident(user_id)
+                return s.get(key) if s else None
+            finally:
+                self._forget(user_id)
+    
+    def set_value(self, user_id, key, value):
+        user_id = str(user_id)
+        with self._lock:
+            try:
+                s = self._state(user_id)
+                if s.get(key) != value:
+                    s.update({key: value})
+                    self._changed(user_id)
+            finally:
+                self._forget(user_id)
+    
+    def gc_stale_flows(self, ttl=FLOW_TTL):
+        """Удаляет формы резидентных сессий, которые не трогали дольше ttl"""
+        cutoff = time.time() - ttl
+        removed = 0
+        with self._lock:
+            for uid, s in self.user_states.items():
+                if s.flow is not None and s.last_action < cutoff:
+                    s.flow = None
+                    self.dirty.add(uid)
+                    removed += 1
+        return removed
+    
+    @span("anchor.track_message")
+    def track_message(self, user_id, message_type, message_id=None):
+        """Отслеживает отправленное сообщение; False — дубликат за последние 2 секунды"""
+        # Записи живут DEDUP_TTL секунд; в общем backend видны всем воркерам
+        return self.backend.check_dedup(f"{user_id}_{message_type}", DEDUP_TTL)
+    
+    def get_offset(self):
+        return self.backend.get_offset()
+    
+    def set_offset(self, offset):
+        self.backend.set_offset(offset)
+    
+    @span("anchor.get_user_state")
     def get_user_state(self, user_id):
         """Получает состояние пользователя"""
-        if user_id not in self.user_states:
-            self.user_states[user_id] = {
-                'last_action': time.time(),
-                'current_category': None,
-                'current_prompt': None,
-                'message_count': 0,
-                'last_keyboard': None,
-                'created_at': datetime.now().isoformat()
-            }
-        return self.user_states[user_id]
+        user_id = str(user_id)
+        with self._lock:
+            try:
+                return self._state(user_id)
+            finally:
+                self._forget(user_id)
+
+    def _state(self, user_id):
+        """Сессия пользователя для изменения; новая — если его ещё нет"""
+        with self._lock:
+            s = self._resident(user_id)
+            if s is None:
+                s = self.user_states[user_id] = Session()
+                self.dirty.add(user_id)
+                self.total_users += 1
+                self._touch(None, s.last_action)
+                self._evict()
+            return s
     
+    @span("anchor.update_user_state")
     def update_user_state(self, user_id, **kwargs):
         """Обновляет состояние пользователя"""
-        state = self.get_user_state(user_id)
-        state.update(kwargs)
-        state['last_action'] = time.time()
-        state['message_count'] = state.get('message_count', 0) + 1
-        self.user_states[user_id] = state
+        user_id = str(user_id)
+        with self._lock:
+            s = self._state(user_id)
+            old_ts = s.last_action
+            s.update(kwargs)
+            s.last_action = time.time()
+            s.message_count += 1
+            self.total_messages += 1
+            self._touch(old_ts, s.last_action)
+            self._changed(user_id)
     
     def clear_user_state(self, user_id):
         """Очищает состояние пользователя"""
-        if user_id in self.user_states:
-            # Сохраняем статистику перед очисткой
-            stats = {
-                'total_messages': self.user_states[user_id].get('message_count', 0),
-                'last_session': datetime.now().isoformat()
-            }
-            # Очищаем текущее состояние, но оставляем статистику
-            self.user_states[user_id] = {
-                'last_action': time.time(),
-                'current_category': None,
-                'current_prompt': None,
-                'message_count': stats['total_messages'],
-                'last_keyboard': None,
-                'stats': stats
-            }
+        user_id = str(user_id)
+        with self._lock:
+            old = self._resident(user_id)
+            if old is not None:
+                now = time.time()
+                self._touch(old.last_action, now)
+                # Очищаем текущее состояние, но оставляем статистику
+                s = self.user_states[user_id] = Session(now)
+                s.created_at = old.created_at
+                s.message_count = old.message_count
+                s.stats = {'total_messages': old.message_count, 'last_session': now}
+                # меню чата остаётся тем же сообщением
+                if old.get('menu_id') is not None:
+                    s.extra = {'menu_id': old.get('menu_id')}
+                self._changed(user_id)
     
     def get_chat_summary(self):
-        """Возвращает статистику чата"""
-        total_users = len(self.user_states)
-        total_messages = sum(state.get('message_count', 0) for state in self.user_states.values())
-        
+        """Возвращает статистику чата (без прохода по пользователям)"""
+        if self.shared:
+            # счётчики других воркеров видны только в общей базе; meta:totals — одно чтение, не агрегат
+            self._load_counters(self.backend.get_meta('totals'))
         return {
-            'total_users': total_users,
-            'total_messages': total_messages,
-            'active_sessions': len([uid for uid, state in self.user_states.items() 
-                                  if time.time() - state.get('last_action', 0) < 3600]),
+            'total_users': self.total_users,
+            'total_messages': self.total_messages,
+            'active_sessions': self.active_sessions(),
+            'resident_sessions': len(self.user_states),
+            'evicted_sessions': self.evicted,
+            'dedup': self.backend.dedup_stats(),
             'last_update': datetime.now().isoformat()
         }
 
-# Глобальный экземпляр якоря
-anchor = ChatHistory()
+# ---------------------------
+# Общий якорь процесса
+# ---------------------------
+_anchor = None
+_anchor_lock = threading.Lock()
 
-# Функция для автосохранения при завершении
-import atexit
-atexit.register(anchor.save_history)
+def get_anchor():
+    """Якорь на chat_history.db в DATA_DIR; создаётся при первом обращении и сохраняется при выходе"""
+    global _anchor
+    with _anchor_lock:
+        if _anchor is None:
+            _anchor = ChatHistory(make_backend(getattr(config, "STATE_BACKEND", None), HISTORY_DB))
+            atexit.register(_anchor.save_history)
+        return _anchor
+
+def __getattr__(name):
+    # context_anchor.anchor — по-прежнему работает, но базу открывает только тот, кто обратился
+    if name == "anchor":
+        return get_anchor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — error log triage
+Groups bot_errors.log entries by normalized stack fingerprint and keeps
+a compact on-disk index that is updated incrementally from the log tail.
+
+Usage:
+    python error_index.py                  # index new tail + top groups
+    python error_index.py --rebuild        # full reindex
+    python error_index.py --show <fp>      # sample traceback of a group
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+ERROR_LOG = os.path.join(BASE, "bot_errors.log")
+
+INDEX_VERSION = 1
+SAMPLE_LIMIT = 4000
+HEAD_BYTES = 4096
+
+# [2025-12-09 15:56:28] message
+HEADER_RE = re.compile(rb"^\[(\d{4}-\d\d-\d\d \d\d):\d\d:\d\d\] ")
+HEADER_TEXT_RE = re.compile(r"^\[[^\]]*\] ")
+FRAME_RE = re.compile(r'^\s*File "([^"]+)", line \d+, in (\S+)')
+EXC_RE = re.compile(r"^([A-Za-z_][\w.]*):")
+
+# то, что меняется от записи к записи, но не меняет смысл ошибки
+NORMALIZERS = [
+    (re.compile(r"bot\d+:[\w-]+"), "bot<token>"),
+    (re.compile(r"0x[0-9a-fA-F]+"), "0x?"),
+    (re.compile(r"'[^']*'"), "'?'"),
+    (re.compile(r"\d+"), "#"),
+]
+
+def default_index_path(log_path):
+    root, _ = os.path.splitext(log_path)
+    return root + ".idx.json"
+
+def normalize(s):
+    for rx, repl in NORMALIZERS:
+        s = rx.sub(repl, s)
+    return s.strip()
+
+def fingerprint(text):
+    """Возвращает (fingerprint, заголовок группы) для одной записи лога"""
+    lines = text.splitlines()
+    frames = []
+    exc = None
+    for ln in lines[1:]:
+        m = FRAME_RE.match(ln)
+        if m:
+            frames.append(f"{os.path.basename(m.group(1))}:{m.group(2)}")
+            continue
+        m = EXC_RE.match(ln)
+        if m:
+            exc = m.group(1)
+    if frames or exc:
+        # у цепочек исключений берём все кадры и последний тип
+        title = f"{exc or '?'} @ {frames[-1] if frames else '?'}"
+        key = "|".join(frames) + "|" + (exc or "")
+    else:
+        title = normalize(HEADER_TEXT_RE.sub("", lines[0]) if lines else "")[:160]
+        key = title
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest(), title
+
+def head_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(HEAD_BYTES), digest_size=8).hexdigest()
+
+def load_index(index_path):
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            idx = json.load(f)
+        if idx.get("version") == INDEX_VERSION:
+            return idx
+    except Exception:
+        pass
+    return None
+
+def save_index(index_path, idx):
+    tmp = index_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(idx, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, index_path)
+
+def iter_entries(f):
+    """Потоково режет лог на записи: (смещение, час, строка с [timestamp] и её продолжение)"""
+    pos = start = f.tell()
+    hour = None
+    buf = []
+    for raw in f:
+        m = HEADER_RE.match(raw)
+        if m:
+            if buf:
+                yield start, hour, b"".join(buf)
+            start = pos
+            hour = m.group(1).decode("ascii")
+            buf = [raw]
+        elif buf:
+            buf.append(raw)
+        # строки до первого заголовка (хвост старой записи) пропускаем
+        pos += len(raw)
+    if buf:
+        yield start, hour, b"".join(buf)
+
+def add_entry(groups, hour, raw):
+    text = raw.decode("utf-8", errors="replace").rstrip()
+    fp, title = fingerprint(text)
+    g = groups.get(fp)
+    if g is None:
+        g = groups[fp] = {
+            "title": title,
+            "count": 0,
+            "first_seen": hour,
+            "last_seen": hour,
+            "hours": {},
+            "sample": text[:SAMPLE_LIMIT],
+        }
+    g["count"] += 1
+    g["last_seen"] = hour
+    g["hours"][hour] = g["hours"].get(hour, 0) + 1
+
+def build_index(log_path, index_path=None, rebuild=False):
+    """Индексирует лог; без rebuild читает только новый хвост"""
+    index_path = index_path or default_index_path(log_path)
+    size = os.path.getsize(log_path)
+    hh = head_hash(log_path)
+    idx = None if rebuild else load_index(index_path)
+    # лог ротировали или обрезали — начинаем заново
+    if idx and (idx.get("head") != hh or idx.get("offset", 0) > size):
+        idx = None
+    if idx is None:
+        idx = {"version": INDEX_VERSION, "log": os.path.abspath(log_path),
+               "head": hh, "offset": 0, "entries": 0, "groups": {}}
+    start = idx["offset"]
+    groups = idx["groups"]
+    n = 0
+    last = None
+    with open(log_path, "rb", buffering=1 << 20) as f:
+        f.seek(start)
+        for entry in iter_entries(f):
+            if last:
+                add_entry(groups, last[1], last[2])
+                n += 1
+            last = entry
+    # последнюю запись трейсбек ещё может дописывать: смещение ставим на её начало,
+    # в сохранённый индекс она не входит и в следующий раз читается целиком заново
+    if last:
+        idx["offset"] = last[0]
+    idx["entries"] += n
+    save_index(index_path, idx)
+    if last:
+        add_entry(groups, last[1], last[2])
+        idx["entries"] += 1
+        n += 1
+    return idx, n, idx["offset"] - start
+
+def print_top(idx, top):
+    groups = sorted(idx["groups"].items(), key=lambda kv: kv[1]["count"], reverse=True)
+    print(f"{idx['entries']} entries, {len(groups)} groups")
+    for fp, g in groups[:top]:
+        peak = max(g["hours"].items(), key=lambda kv: kv[1])
+        print(f"{fp}  {g['count']:>7}  {g['first_seen']} .. {g['last_seen']}  "
+              f"peak {peak[0]}h={peak[1]}  {g['title']}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Index and triage bot_errors.log")
+    ap.add_argument("log", nargs="?", default=ERROR_LOG)
+    ap.add_argument("--index", help="index file (default: <log>.idx.json)")
+    ap.add_argument("--rebuild", action="store_true", help="reindex the whole log")
+    ap.add_argument("--top", type=int, default=20)
+    ap.add_argument("--show", metavar="FP", help="print sample and hourly counts of a group")
+    args = ap.parse_args(argv)
+
+    if not os.path.exists(args.log):
+        raise SystemExit(f"log not found: {args.log}")
+    idx, n, nbytes = build_index(args.log, args.index, args.rebuild)
+    if args.show:
+        g = idx["groups"].get(args.show)
+        if not g:
+            raise SystemExit(f"unknown fingerprint: {args.show}")
+        print(f"{g['title']}  count={g['count']}  {g['first_seen']} .. {g['last_seen']}")
+        for h, c in sorted(g["hours"].items()):
+            print(f"  {h}h  {c}")
+        print()
+        print(g["sample"])
+        return 0
+    print(f"indexed {n} new entries ({nbytes} bytes)", file=sys.stderr)
+    print_top(idx, args.top)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — local fake Telegram Bot API
+Enough of the Bot API for benchmarks and local runs: getUpdates with
+long polling, sendMessage & co. are recorded instead of delivered.
+
+    python fake_api.py --port 8081 --latency 0.02
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 python bot_pro_fixed.py
+
+Control endpoints (not part of the Bot API):
+    POST /_inject   [update, ...]  — поставить апдейты в очередь getUpdates
+    GET  /_sent                    — записанные исходящие вызовы
+    GET  /_stats                   — счётчики по методам
+    POST /_reset                   — очистить всё
+    POST /_fault    {"mode": ..., "rate": 1.0, "seconds": 30}
+    POST /_file?file_id=ID  <bytes> — файл для getFile и /file/bot<token>/...
+
+Stand-in generation backend (OpenAI-compatible, streaming only):
+    POST /v1/chat/completions      — GEN_API_BASE=http://127.0.0.1:8081/v1
+
+Fault modes for Bot API calls (control endpoints are never affected):
+    error — HTTP 502;  drop — connection closed without a reply;
+    hang  — no reply for HANG_SECONDS;  null / off — faults off
+
+api.blocked (chat ids answered with 403) and api.send_rate (sendMessage
+per second before 429) model users who blocked the bot and flood limits.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FAULT_MODES = ("error", "drop", "hang")
+HANG_SECONDS = 60
+GEN_CHUNK_DELAY = 0.05  # пауза между кусками ответа stand-in генерации
+
+class FakeTelegram:
+    """Состояние fake API: очередь апдейтов и журнал исходящих вызовов"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.updates = []
+        self.next_update_id = 1
+        self.sent = []
+        self.counts = {}
+        self.next_message_id = 1
+        self.fault = None
+        self.fault_rate = 1.0
+        self.fault_until = None
+        self.files = {}  # file_id -> bytes
+        self.poll_gen = 0  # номер последнего getUpdates: ждущие старые завершаются 409
+        self.blocked = set()  # chat_id, заблокировавшие бота: sendMessage -> 403
+        self.send_rate = None  # лимит отправок в секунду; сверх него — 429
+        self._window = [0, 0]  # [секунда, отправок в ней]
+        self.cond = threading.Condition()
+
+    def set_fault(self, mode, rate=1.0, seconds=None):
+        """Включает отказ mode для доли rate вызовов (на seconds секунд); None — выключает"""
+        if mode in (None, "off", "none", ""):
+            mode = None
+        elif mode not in FAULT_MODES:
+            raise ValueError(f"unknown fault mode: {mode}")
+        with self.cond:
+            self.fault = mode
+            self.fault_rate = float(rate)
+            self.fault_until = time.time() + float(seconds) if seconds else None
+
+    def pick_fault(self):
+        """Отказ для очередного вызова или None"""
+        with self.cond:
+            if self.fault and self.fault_until and time.time() >= self.fault_until:
+                self.fault = None
+            if self.fault is None or random.random() >= self.fault_rate:
+                return None
+            self.counts["_faults"] = self.counts.get("_faults", 0) + 1
+            return self.fault
+
+    def inject(self, updates):
+        with self.cond:
+            for upd in updates:
+                upd = dict(upd)
+                upd.setdefault("update_id", self.next_update_id)
+                self.next_update_id = max(self.next_update_id, upd["update_id"]) + 1
+                self.updates.append(upd)
+            self.cond.notify_all()
+
+    def get_updates(self, offset=0, limit=100, timeout=0):
+        """Апдейты от offset; None — long poll вытеснен более новым getUpdates (409 у Telegram)"""
+        deadline = time.time() + timeout
+        with self.cond:
+            self.counts["getUpdates"] = self.counts.get("getUpdates", 0) + 1
+            self.poll_gen += 1
+            gen = self.poll_gen
+            self.cond.notify_all()
+            # подтверждённые offset'ом апдейты больше не нужны
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+                if self.poll_gen != gen:
+                    return None
+            return self.updates[:limit]
+
+    def call(self, method, payload):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.cond:
+            self.counts[method] = self.counts.get(method, 0) + 1
+            if method == "sendMessage":
+                if self.send_rate:
+                    sec = int(time.time())
+                    self._window = [sec, self._window[1] + 1] if self._window[0] == sec else [sec, 1]
+                    if self._window[1] > self.send_rate:
+                        self.counts["_429"] = self.counts.get("_429", 0) + 1
+                        return {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                "parameters": {"retry_after": 1}}
+                if str(payload.get("chat_id")) in self.blocked:
+                    return {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            self.sent.append({"t": time.time(), "method": method, "payload": payload})
+            if method in ("sendMessage", "sendDocument", "editMessageText"):
+                mid = payload.get("message_id") or self.next_message_id
+                self.next_message_id += 1
+                chat = {"id": payload.get("chat_id")}
+                return {"ok": True, "result": {"message_id": mid, "chat": chat,
+                                               "text": payload.get("text", "")}}
+            if method == "getFile":
+                file_id = payload.get("file_id")
+                if file_id not in self.files:
+                    return {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+                return {"ok": True, "result": {"file_id": file_id, "file_size": len(self.files[file_id]),
+                                               "file_path": f"documents/{file_id}"}}
+        return {"ok": True, "result": True}
+
+    def add_file(self, file_id, data):
+        """Файл, который бот сможет скачать через getFile"""
+        with self.cond:
+            self.files[file_id] = bytes(data)
+
+    def completion_chunks(self, payload):
+        """Детерминированный «ответ модели» по словам: повторяет последний запрос пользователя"""
+        with self.cond:
+            self.counts["completions"] = self.counts.get("completions", 0) + 1
+        messages = payload.get("messages") or [{}]
+        prompt = str(messages[-1].get("content", ""))
+        words = f"Ответ на запрос: {prompt}".split(" ")
+        return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+    def reset(self):
+        with self.cond:
+            self.updates, self.sent, self.counts = [], [], {}
+            self.fault = None
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # заголовки и тело уходят разными write: без TCP_NODELAY keep-alive клиент ждёт delayed ACK ~40 мс
+        disable_nagle_algorithm = True
+
+        def _reply(self, obj, status=200):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _payload(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(n) if n else b""
+            ctype = self.headers.get("Content-Type", "")
+            payload = {}
+            q = parse_qs(urlparse(self.path).query)
+            payload.update({k: v if len(v) > 1 else v[0] for k, v in q.items()})
+            if raw and "json" in ctype:
+                body = json.loads(raw)
+                if isinstance(body, list):
+                    return body
+                payload.update(body)
+            elif raw and "urlencoded" in ctype:
+                payload.update({k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()})
+            # multipart (sendDocument) не разбираем — достаточно факта вызова
+            return payload
+
+        def _route(self):
+            path = urlparse(self.path).path
+            if path == "/_file":
+                # тело — сам файл, не JSON
+                n = int(self.headers.get("Content-Length") or 0)
+                api.add_file(parse_qs(urlparse(self.path).query).get("file_id", [""])[0], self.rfile.read(n) if n else b"")
+                return self._reply({"ok": True})
+            payload = self._payload()
+            if path == "/_inject":
+                api.inject(payload if isinstance(payload, list) else payload.get("updates", []))
+                return self._reply({"ok": True})
+            if path == "/_sent":
+                with api.cond:
+                    return self._reply(api.sent)
+            if path == "/_stats":
+                with api.cond:
+                    return self._reply({"counts": api.counts, "pending": len(api.updates)})
+            if path == "/_reset":
+                api.reset()
+                return self._reply({"ok": True})
+            if path == "/_fault":
+                try:
+                    api.set_fault(payload.get("mode"), payload.get("rate", 1.0), payload.get("seconds"))
+                except ValueError as e:
+                    return self._reply({"ok": False, "description": str(e)}, 400)
+                return self._reply({"ok": True})
+            if path.startswith("/file/"):
+                return self._send_file(path.rsplit("/", 1)[-1])
+            if path == "/v1/chat/completions":
+                return self._stream_completion(payload)
+            parts = path.strip("/").split("/")
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                return self._reply({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+            method = parts[1]
+            fault = api.pick_fault()
+            if fault == "error":
+                return self._reply({"ok": False, "error_code": 502, "description": "Bad Gateway"}, 502)
+            if fault == "drop":
+                self.close_connection = True
+                return
+            if fault == "hang":
+                time.sleep(HANG_SECONDS)
+                self.close_connection = True
+                return
+            if method == "getUpdates":
+                res = api.get_updates(int(payload.get("offset", 0) or 0),
+                                      int(payload.get("limit", 100) or 100),
+                                      float(payload.get("timeout", 0) or 0))
+                if res is None:
+                    return self._reply({"ok": False, "error_code": 409,
+                                        "description": "Conflict: terminated by other getUpdates request"}, 409)
+                return self._reply({"ok": True, "result": res})
+            res = api.call(method, payload)
+            return self._reply(res, res.get("error_code", 200))
+
+        def _send_file(self, file_id):
+            with api.cond:
+                data = api.files.get(file_id)
+            if data is None:
+                return self._reply({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream_completion(self, payload):
+            fault = api.pick_fault()
+            if fault:
+                return self._reply({"error": {"message": f"injected {fault}"}}, 502)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for piece in api.completion_chunks(payload):
+                chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": piece}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(GEN_CHUNK_DELAY)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        do_GET = _route
+        do_POST = _route
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def serve(port=8081, latency=0.0, host="127.0.0.1"):
+    """Запускает fake API в фоновом потоке; возвращает (server, api)"""
+    api = FakeTelegram(latency)
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, api
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every outbound call")
+    ap.add_argument("--fault", choices=FAULT_MODES, help="start with this fault mode on")
+    ap.add_argument("--fault-rate", type=float, default=1.0, help="share of Bot API calls that fail")
+    args = ap.parse_args(argv)
+    server, api = serve(args.port, args.latency)
+    if args.fault:
+        api.set_fault(args.fault, args.fault_rate)
+    print(f"fake Bot API on http://127.0.0.1:{args.port}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
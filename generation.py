@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — "run it": generation through an OpenAI-compatible backend
+The finished prompt is sent to /chat/completions with stream=true; jobs go
+through a bounded queue served by a few worker threads, with a per-chat
+limit, so the update dispatcher never waits for a completion.
+
+    GEN_API_BASE = "https://api.openai.com/v1"   # config.py; без него кнопки нет
+    GEN_API_KEY = "sk-..."
+    GEN_MODEL = "gpt-4o-mini"
+
+fake_api.py serves a stand-in /v1/chat/completions for local runs.
+"""
+
+import json
+import time
+import queue
+import threading
+
+from pools import HTTP
+
+GEN_WORKERS = 2
+GEN_QUEUE_MAX = 100
+GEN_PER_CHAT = 1
+GEN_TIMEOUT = 120
+
+QUEUED, BUSY, FULL = "queued", "busy", "full"
+
+class Backend:
+    """Клиент OpenAI-совместимого /chat/completions со стримингом"""
+
+    def __init__(self, base, api_key=None, model="gpt-4o-mini", timeout=GEN_TIMEOUT):
+        self.url = base.rstrip("/") + "/chat/completions"
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+
+    def stream(self, prompt):
+        """Куски ответа по мере генерации (server-sent events)"""
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        payload = {"model": self.model, "stream": True,
+                   "messages": [{"role": "user", "content": prompt}]}
+        with HTTP.post(self.url, json=payload, headers=headers, stream=True, timeout=(3.05, self.timeout)) as r:
+            r.raise_for_status()
+            r.encoding = "utf-8"  # SSE всегда UTF-8, даже без charset в Content-Type
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)["choices"][0].get("delta", {})
+                except (ValueError, KeyError, IndexError):
+                    continue
+                if delta.get("content"):
+                    yield delta["content"]
+
+class JobQueue:
+    """Ограниченная очередь задач с лимитом одновременных задач на чат"""
+
+    def __init__(self, workers=GEN_WORKERS, max_pending=GEN_QUEUE_MAX, per_chat=GEN_PER_CHAT, on_error=None):
+        self.q = queue.Queue(maxsize=max_pending)
+        self.per_chat = per_chat
+        self.active = {}  # chat_id -> задач в очереди и в работе
+        self.on_error = on_error or (lambda chat_id, e: None)
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"gen-{i}", daemon=True).start()
+
+    def submit(self, chat_id, fn):
+        """QUEUED, BUSY (у чата уже есть задача) или FULL (очередь переполнена)"""
+        with self._lock:
+            if self.active.get(chat_id, 0) >= self.per_chat:
+                return BUSY
+            try:
+                self.q.put_nowait((chat_id, fn))
+            except queue.Full:
+                return FULL
+            self.active[chat_id] = self.active.get(chat_id, 0) + 1
+        return QUEUED
+
+    def _worker(self):
+        while True:
+            chat_id, fn = self.q.get()
+            try:
+                fn()
+            except Exception as e:
+                self.on_error(chat_id, e)
+            finally:
+                with self._lock:
+                    n = self.active.get(chat_id, 1) - 1
+                    if n > 0:
+                        self.active[chat_id] = n
+                    else:
+                        self.active.pop(chat_id, None)
+
+    def depth(self):
+        return self.q.qsize()
+
+    def drain(self, timeout):
+        """Ждёт, пока очередь и работающие задачи не кончатся; False — не успели"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self.active:
+                    return True
+            time.sleep(0.05)
+        return False
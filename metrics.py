@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — metrics
+Counters, gauges and histograms in Prometheus text format, served on a
+local port (off unless configured):
+
+    METRICS_PORT = 9108            # config.py или PROMPTBINDER_METRICS_PORT
+    curl http://127.0.0.1:9108/metrics
+
+In sharded mode worker i listens on METRICS_PORT + 1 + i. Several bots in
+one process (tenancy.py) share the endpoint: each registers its callbacks
+with add_function and the values are combined per metric — summed, the
+worst one for state gauges (combine=max), or pooled for ratios (combine=ratio).
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_metrics = []  # в порядке регистрации, чтобы вывод был стабильным
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def ratio(got):
+    """combine для долей: fn отдают (часть, всего), значения ботов складываются до деления"""
+    total = sum(t for _, t in got)
+    return sum(p for p, _ in got) / total if total else 0.0
+
+def _fmt(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), combine=sum):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.values = {}
+        self.fns = {}  # значения, которые считает чужой код (счётчики якоря, длины очередей): key -> [fn]
+        self.combine = combine  # как сводить значения нескольких fn одного ключа
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.label_names)
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def set_function(self, fn, **labels):
+        """Значение вычисляется fn() при каждом сборе"""
+        self.fns[self._key(labels)] = [fn]
+
+    def add_function(self, fn, **labels):
+        """Ещё один источник того же значения (бот в tenancy.py); значения сводятся combine"""
+        with _lock:
+            self.fns.setdefault(self._key(labels), []).append(fn)
+
+    def samples(self):
+        values = dict(self.values)
+        for key, fns in list(self.fns.items()):
+            got = []
+            for fn in fns:
+                try:
+                    got.append(fn())
+                except Exception:
+                    continue
+            if got:
+                values[key] = self.combine(got)
+        for key, v in sorted(values.items()):
+            yield self.name, key, v
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, v, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = v
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # key -> [counts per bucket..., +Inf], sum
+        with _lock:
+            _metrics.append(self)
+
+    def observe(self, v, **labels):
+        key = tuple(str(labels.get(l, "")) for l in self.label_names)
+        i = bisect.bisect_left(self.buckets, v)
+        with _lock:
+            st = self.values.get(key)
+            if st is None:
+                st = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            st[0][i] += 1
+            st[1] += v
+
+    @contextmanager
+    def time(self, **labels):
+        """with HIST.time(handler=...): или @HIST.time(handler=...) над функцией"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            acc = 0
+            for b, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                yield self.name + "_bucket", key + (_fmt(b),), acc
+            yield self.name + "_sum", key, total
+            yield self.name + "_count", key, acc
+
+    def _names(self, sample_name):
+        return self.label_names + ("le",) if sample_name.endswith("_bucket") else self.label_names
+
+def render():
+    """Все метрики в текстовом формате Prometheus 0.0.4"""
+    out = []
+    with _lock:
+        metrics = list(_metrics)
+    for m in metrics:
+        out.append(f"# HELP {m.name} {m.help}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        for name, key, v in m.samples():
+            names = m._names(name) if isinstance(m, Histogram) else m.label_names
+            out.append(f"{name}{_labels(names, key)} {_fmt(v)}")
+    return "\n".join(out) + "\n"
+
+def serve(port, host="127.0.0.1"):
+    """Отдаёт /metrics в фоновом потоке"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404); self.end_headers(); return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# ---------------------------
+# PromptBinder metrics
+# ---------------------------
+HANDLER_SECONDS = Histogram("promptbinder_handler_seconds", "Time spent in update handlers", ["handler"])
+API_SECONDS = Histogram("promptbinder_api_seconds", "Telegram Bot API round trip time", ["method"])
+API_RESPONSES = Counter("promptbinder_api_responses_total", "Telegram Bot API responses by HTTP status", ["method", "status"])
+FLUSH_SECONDS = Histogram("promptbinder_flush_seconds", "Time to persist a store", ["store"])
+UPDATES = Counter("promptbinder_updates_total", "Updates dispatched", ["kind"])
+QUEUE_DEPTH = Gauge("promptbinder_queue_depth", "Items waiting in internal queues", ["queue"])
+DEDUP = Counter("promptbinder_dedup_total", "Anchor dedup lookups by result", ["result"])
+ADMISSION = Counter("promptbinder_admission_total", "Updates by admission decision (admit, drop, merge)", ["result"])
+CIRCUIT_STATE = Gauge("promptbinder_circuit_state", "Bot API circuit breaker: 0 closed, 1 half-open, 2 open", combine=max)
+API_HEDGES = Counter("promptbinder_api_hedges_total", "Hedged getUpdates requests issued")
+DEGRADATION_LEVEL = Gauge("promptbinder_degradation_level", "Overload degradation level, 0 = normal .. 4 = intake paused", combine=max)
+OVERLOAD_PRESSURE = Gauge("promptbinder_overload_pressure", "Max of normalized API latency, API error rate and queue depth", combine=max)
+GEN_JOBS = Counter("promptbinder_generation_jobs_total", "Generation requests by outcome", ["result"])
+GEN_SECONDS = Histogram("promptbinder_generation_seconds", "Generation job duration, first byte to final edit")
+RESULT_CACHE_LOOKUPS = Counter("promptbinder_result_cache_total", "Result cache lookups by tier (memory, disk, miss)", ["tier"])
+RESULT_CACHE_HIT_RATE = Gauge("promptbinder_result_cache_hit_ratio", "Share of result cache lookups served from memory or disk", combine=ratio)
+BULK_JOBS = Counter("promptbinder_bulk_jobs_total", "Bulk file jobs by outcome", ["result"])
+BULK_ROWS = Counter("promptbinder_bulk_rows_total", "Rows rendered by bulk file jobs")
+BROADCAST_SENDS = Counter("promptbinder_broadcast_sends_total", "Broadcast deliveries by result (sent, blocked, failed, retry, unavailable)", ["result"])
+MAINT_SECONDS = Histogram("promptbinder_maintenance_seconds", "Maintenance job run time", ["job"])
+MAINT_CPU = Counter("promptbinder_maintenance_cpu_seconds_total", "CPU time spent in maintenance jobs", ["job"])
+MAINT_RUNS = Counter("promptbinder_maintenance_runs_total", "Maintenance job runs by result (ok, error, deferred)", ["job", "result"])
+LOOP_LAG = Gauge("promptbinder_loop_lag_seconds", "How late the polling loop woke up after its pause")
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — overload detection and graceful degradation
+Bot API latency and error rate (EWMA) plus internal queue depths are folded
+into one pressure value; pressure maps to a degradation level:
+
+    0  normal
+    1  sample non-critical stats (recv / send_ok / field)
+    2  + defer anchor persistence
+    3  + skip the re-menu after a finished prompt (0.6 s pause + one send)
+    4  + pause getUpdates intake
+
+Levels go up at once and come down one step at a time after COOLDOWN
+seconds of lower pressure. The latency and error EWMAs decay with time
+when no API calls are recorded (DECAY_HALF_LIFE), so a level reached
+during an outage is left even while intake is paused and nothing is sent.
+"""
+
+import time
+import threading
+
+LATENCY_HIGH = 1.0       # с, EWMA RTT Bot API, при котором давление = 1
+ERROR_RATE_HIGH = 0.2    # доля неудачных вызовов
+QUEUE_HIGH = 500         # апдейтов в очереди
+EWMA_ALPHA = 0.1
+LEVEL_AT = (0.5, 0.75, 1.0, 1.5)  # порог давления для уровней 1..4
+COOLDOWN = 10.0
+EVALUATE_EVERY = 0.5
+DECAY_HALF_LIFE = 5.0    # с без вызовов API, за которые EWMA латентности и ошибок падают вдвое
+
+NORMAL, SAMPLE_STATS, DEFER_PERSIST, SKIP_REMENU, PAUSE_INTAKE = range(5)
+
+class Governor:
+    """Следит за нагрузкой и переключает уровни деградации"""
+
+    def __init__(self, latency_high=LATENCY_HIGH, error_rate_high=ERROR_RATE_HIGH, queue_high=QUEUE_HIGH,
+                 cooldown=COOLDOWN, clock=time.monotonic):
+        self.latency_high = latency_high
+        self.error_rate_high = error_rate_high
+        self.queue_high = queue_high
+        self.cooldown = cooldown
+        self.clock = clock
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.queues = []         # функции, возвращающие длину очереди
+        self.listeners = []      # fn(level) при смене уровня
+        self.level = NORMAL
+        self.pressure = 0.0
+        self._below_since = None
+        self._last_eval = 0.0
+        self._last_seen = clock()  # последний record() или затухание
+        self._lock = threading.Lock()
+
+    def add_queue(self, fn):
+        self.queues.append(fn)
+
+    def on_change(self, fn):
+        self.listeners.append(fn)
+
+    def record(self, seconds, ok):
+        """Один вызов Bot API: RTT (None — не учитывать, как у long poll) и успех"""
+        with self._lock:
+            if seconds is not None:
+                self.latency += EWMA_ALPHA * (seconds - self.latency)
+            self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+            self._last_seen = self.clock()
+        if self.clock() - self._last_eval >= EVALUATE_EVERY:
+            self.evaluate()
+
+    def queue_depth(self):
+        depth = 0
+        for fn in self.queues:
+            try:
+                depth += fn()
+            except Exception:
+                continue
+        return depth
+
+    def evaluate(self):
+        """Пересчитывает давление и уровень; возвращает текущий уровень"""
+        now = self.clock()
+        depth = self.queue_depth()
+        with self._lock:
+            self._last_eval = now
+            idle = now - self._last_seen
+            if idle >= EVALUATE_EVERY:
+                # вызовов нет (например, приём на паузе): старые замеры устаревают
+                factor = 0.5 ** (idle / DECAY_HALF_LIFE)
+                self.latency *= factor
+                self.error_rate *= factor
+                self._last_seen = now
+            self.pressure = max(self.latency / self.latency_high,
+                                self.error_rate / self.error_rate_high,
+                                depth / self.queue_high)
+            target = sum(1 for t in LEVEL_AT if self.pressure >= t)
+            old = self.level
+            if target > old:
+                self.level, self._below_since = target, None
+            elif target < old:
+                if self._below_since is None:
+                    self._below_since = now
+                elif now - self._below_since >= self.cooldown:
+                    self.level, self._below_since = old - 1, now
+            else:
+                self._below_since = None
+            level = self.level
+        if level != old:
+            for fn in self.listeners:
+                try:
+                    fn(level)
+                except Exception:
+                    pass
+        return level
+
+    def at_least(self, level):
+        return self.level >= level
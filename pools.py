@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — process-wide pools
+One keep-alive HTTP connection pool and one small worker pool for
+fire-and-forget calls (callback acks). Every bot hosted in the process
+(tenancy.py) uses these instead of opening its own connections and threads.
+The getUpdates pool, generation and bulk queues and the maintenance
+scheduler of tenant bots are shared the same way through shared().
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = 32   # соединений на хост; long poll каждого бота держит одно
+ACK_WORKERS = 8
+
+HTTP = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+HTTP.mount("https://", _adapter)
+HTTP.mount("http://", _adapter)
+
+ACKS = ThreadPoolExecutor(max_workers=ACK_WORKERS, thread_name_prefix="cb-ack")
+
+TENANTS = 1  # ботов в процессе; tenancy.py выставляет до загрузки, пулы растут по нему
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared(name, factory):
+    """Один объект на процесс: создаёт первый бот, которому он нужен, остальные берут тот же"""
+    with _shared_lock:
+        if name not in _shared:
+            _shared[name] = factory()
+        return _shared[name]
+
+def shutdown():
+    """Останавливает общие пулы и планировщик, когда все боты процесса закончили"""
+    with _shared_lock:
+        objs = list(_shared.values())
+    for obj in objs:
+        if hasattr(obj, "shutdown"):
+            obj.shutdown(wait=True)
+        elif hasattr(obj, "stop"):
+            obj.stop()
+    ACKS.shutdown(wait=True)
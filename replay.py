@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — replay recorded traffic
+Turns the "recv" rows of stats.csv into updates and feeds them to the bot
+through the local fake Bot API, at the recorded pace, N times faster or as
+fast as possible. Reports throughput and handling latency, and compares
+the replies each chat got against a recorded baseline.
+
+    python replay.py stats.csv --speed 0 --record baseline.json
+    python replay.py stats.csv --speed 0 --baseline baseline.json
+
+Record and compare at the same speed: anchor dedup (2 s) is time based,
+so the reply sequence legitimately depends on pacing. Flood control is off
+unless --flood is given, for the same reason.
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+import fake_api
+
+REPLY_CHARS = 80
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def read_events(path, limit=None):
+    """(ts, chat_id, text) для строк recv; текст в stats.csv обрезан до 120 символов"""
+    events = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        for row in rows:
+            if len(row) < 4 or row[2] != "recv":
+                continue
+            try:
+                ts = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").timestamp()
+                chat_id = int(row[1])
+            except ValueError:
+                continue
+            events.append((ts, chat_id, row[3]))
+            if limit and len(events) >= limit:
+                break
+    events.sort(key=lambda e: e[0])  # sort стабилен: порядок внутри секунды сохраняется
+    return events
+
+def replies(sent):
+    """Ответы бота по чатам: [[метод, начало текста], ...]"""
+    out = {}
+    for call in sent:
+        p = call["payload"]
+        chat = p.get("chat_id")
+        if chat is None:
+            continue
+        out.setdefault(str(chat), []).append([call["method"], str(p.get("text", ""))[:REPLY_CHARS]])
+    return out
+
+def compare(baseline, got):
+    """Список (chat_id, ожидалось, получено) для чатов с расхождением"""
+    diffs = []
+    for chat in sorted(set(baseline) | set(got)):
+        a, b = baseline.get(chat, []), got.get(chat, [])
+        if a != b:
+            i = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            diffs.append((chat, a[i] if i < len(a) else None, b[i] if i < len(b) else None))
+    return diffs
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def run(events, speed, latency, flood, timeout):
+    port = free_port()
+    server, api = fake_api.serve(port, latency)
+    os.environ["TELEGRAM_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["PROMPTBINDER_DATA"] = tempfile.mkdtemp(prefix="replay-")
+    import bot_pro_fixed as bot
+    if not flood:
+        bot.FLOOD.rate = bot.FLOOD.burst = 1e9
+        bot.FLOOD.window = 0
+
+    injected = {}   # update_id -> момент подачи
+    handled = {}    # update_id -> момент конца обработки
+    done = threading.Event()
+
+    def dispatch(upd):
+        bot.handle_update(upd)
+        handled[upd["update_id"]] = time.perf_counter()
+        if len(handled) >= len(events):
+            done.set()
+
+    threading.Thread(target=bot.polling, kwargs={"dispatch": dispatch}, daemon=True).start()
+    while api.counts.get("getUpdates", 0) < 1:
+        time.sleep(0.01)
+
+    t0 = time.perf_counter()
+    first_ts = events[0][0] if events else 0
+    for i, (ts, chat_id, text) in enumerate(events, 1):
+        if speed:
+            delay = (ts - first_ts) / speed - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+        injected[i] = time.perf_counter()
+        api.inject([{"update_id": i, "message": {"message_id": i, "chat": {"id": chat_id}, "text": text}}])
+    finished = done.wait(timeout) or not events
+    elapsed = time.perf_counter() - t0
+    lat = [handled[u] - injected[u] for u in handled if u in injected]
+    with api.cond:
+        got = replies(api.sent)
+    server.shutdown()
+    return {"finished": finished, "elapsed": elapsed, "handled": len(handled), "latency": lat, "replies": got}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay recv events from stats.csv against the fake Bot API")
+    ap.add_argument("stats", nargs="?", default="stats.csv")
+    ap.add_argument("--speed", type=float, default=1.0, help="1 = recorded pace, N = N times faster, 0 = max")
+    ap.add_argument("--limit", type=int, help="replay only the first N events")
+    ap.add_argument("--latency", type=float, default=0.0, help="fake API latency per call, seconds")
+    ap.add_argument("--flood", action="store_true", help="keep per-chat flood control on")
+    ap.add_argument("--record", help="write the reply sequences to this baseline file")
+    ap.add_argument("--baseline", help="compare the reply sequences with this baseline file")
+    ap.add_argument("--timeout", type=float, default=600)
+    args = ap.parse_args(argv)
+
+    events = read_events(args.stats, args.limit)
+    span_s = events[-1][0] - events[0][0] if events else 0
+    print(f"events={len(events)} chats={len({e[1] for e in events})} recorded_span={span_s:.0f}s speed={args.speed or 'max'}")
+    res = run(events, args.speed, args.latency, args.flood, args.timeout)
+    lat = res["latency"]
+    rate = res["handled"] / res["elapsed"] if res["elapsed"] else 0.0
+    print(f"handled={res['handled']}/{len(events)} elapsed={res['elapsed']:.2f}s throughput={rate:.1f} upd/s"
+          + ("" if res["finished"] else "  (timeout)"))
+    if lat:
+        print(f"latency p50={pct(lat, 0.5) * 1000:.1f}ms p95={pct(lat, 0.95) * 1000:.1f}ms "
+              f"p99={pct(lat, 0.99) * 1000:.1f}ms max={max(lat) * 1000:.1f}ms")
+
+    status = 0 if res["finished"] else 1
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            json.dump({"speed": args.speed, "events": len(events), "replies": res["replies"]}, f, ensure_ascii=False, indent=1)
+        print(f"baseline written: {args.record} ({len(res['replies'])} chats)")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        if base.get("speed") != args.speed:
+            print(f"warning: baseline recorded at speed {base.get('speed')}, replaying at {args.speed}")
+        diffs = compare(base["replies"], res["replies"])
+        total = len(set(base["replies"]) | set(res["replies"]))
+        print(f"baseline: {total - len(diffs)}/{total} chats match")
+        for chat, want, got in diffs[:10]:
+            print(f"  chat {chat}: expected {want} got {got}")
+        if diffs:
+            status = 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — result cache for generated outputs
+Two tiers: an in-memory LRU in front of a size-bounded SQLite file. Keys
+are a hash of the prompt key, the template version and the normalized
+field values, so the same form filled the same way costs no backend call.
+The size limit is checked against the pages in use in the file itself, so
+it holds when several processes share one results.db.
+"""
+
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+MEMORY_ENTRIES = 1000
+DISK_MAX_BYTES = 50 * 1024 * 1024
+TTL = 7 * 24 * 3600
+
+def _norm(v):
+    return " ".join(str(v).split()).casefold()
+
+def make_key(prompt_key, template, values, model=""):
+    """Ключ результата: регистр и лишние пробелы в значениях полей не важны"""
+    data = json.dumps([prompt_key, list(template), sorted((_norm(k), _norm(v)) for k, v in values.items()), model],
+                      ensure_ascii=False)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+class ResultCache:
+    def __init__(self, path, memory_entries=MEMORY_ENTRIES, disk_max_bytes=DISK_MAX_BYTES, ttl=TTL):
+        self.memory = OrderedDict()  # key -> (value, expires)
+        self.memory_entries = memory_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self.hits = {"memory": 0, "disk": 0, "miss": 0}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, "
+                          "expires REAL, size INTEGER, atime REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_atime ON results(atime)")
+        self.conn.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            hit = self.memory.get(key)
+            if hit is not None and hit[1] > now:
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return hit[0]
+            row = self.conn.execute("SELECT value, expires FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                self.hits["miss"] += 1
+                return None
+            self.conn.execute("UPDATE results SET atime = ? WHERE key = ?", (now, key))
+            self._remember(key, row[0], row[1])
+            self.hits["disk"] += 1
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        expires = now + self.ttl
+        size = len(value.encode("utf-8")) + len(key)
+        with self._lock:
+            self._remember(key, value, expires)
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, value, expires, size, now))
+            if self.disk_bytes() > self.disk_max_bytes:
+                self._shrink()
+
+    def disk_bytes(self):
+        """Занятые страницы файла; свободные (после DELETE) файл не сжимают, но переиспользуются"""
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * self.conn.execute("PRAGMA page_size").fetchone()[0]
+
+    def _remember(self, key, value, expires):
+        self.memory[key] = (value, expires)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _shrink(self):
+        """Удаляет давно не читанные записи, пока файл не уложится в 90% лимита"""
+        target = self.disk_max_bytes * 0.9
+        while True:
+            over = self.disk_bytes() - target
+            if over <= 0:
+                break
+            rows = self.conn.execute("SELECT key, size FROM results ORDER BY atime LIMIT 256").fetchall()
+            if not rows:
+                break
+            # size — оценка: страница освобождается, только когда опустеет целиком, поэтому проверяем заново
+            victims = []
+            for key, size in rows:
+                victims.append((key,))
+                over -= size
+                if over <= 0:
+                    break
+            self.conn.executemany("DELETE FROM results WHERE key = ?", victims)
+
+    def expire(self):
+        """Удаляет протухшие записи из памяти и с диска; число удалённых с диска"""
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, exp) in self.memory.items() if exp <= now]:
+                del self.memory[key]
+            n = self.conn.execute("DELETE FROM results WHERE expires < ?", (now,)).rowcount
+        return n
+
+    def lookups(self):
+        """(попадания, все обращения) для доли попаданий; по ботам процесса сводит metrics.ratio"""
+        return self.hits["memory"] + self.hits["disk"], sum(self.hits.values())
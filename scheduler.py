@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — background maintenance scheduler
+A hashed timer wheel on one daemon thread: periodic flushes, compaction,
+TTL eviction, log rotation and summary snapshots run on their own
+intervals instead of piggybacking on request counters.
+
+* each job gets a random first phase and +-jitter on every interval, so
+  jobs (and sharded workers) do not fire in lockstep;
+* run time and CPU time are recorded per job (promptbinder_maintenance_*);
+* maintenance CPU is capped: when the jobs used more than cpu_share of one
+  core over the last CPU_WINDOW seconds, due jobs are pushed back — except
+  cheap ones (a flush that costs microseconds does not help the budget).
+"""
+
+import time
+import random
+import threading
+from collections import deque
+
+from metrics import MAINT_SECONDS, MAINT_CPU, MAINT_RUNS
+
+TICK = 0.25          # шаг колеса, секунд
+SLOTS = 256          # оборот колеса — 64 с; задачи дальше ждут своего оборота в слоте
+JITTER = 0.1         # +-10% к интервалу
+CPU_SHARE = 0.05     # не больше 5% одного ядра на обслуживание
+CPU_WINDOW = 10.0
+DEFER = 1.0          # на сколько откладывать задачу сверх бюджета CPU
+CHEAP_CPU = 0.005    # задачи дешевле этого (по прошлому запуску) бюджет не откладывает
+
+class Job:
+    __slots__ = ("name", "interval", "fn", "jitter", "due", "runs", "errors", "deferred", "last_seconds", "last_cpu")
+
+    def __init__(self, name, interval, fn, jitter):
+        self.name, self.interval, self.fn, self.jitter = name, interval, fn, jitter
+        self.due = 0  # абсолютный номер тика
+        self.runs = self.errors = self.deferred = 0
+        self.last_seconds = self.last_cpu = 0.0
+
+class Scheduler:
+    """Колесо таймеров: задача лежит в слоте due % SLOTS и запускается, когда наступил её тик"""
+
+    def __init__(self, tick=TICK, slots=SLOTS, cpu_share=CPU_SHARE, on_error=None, clock=time.monotonic):
+        self.tick = tick
+        self.wheel = [[] for _ in range(slots)]
+        self.cpu_share = cpu_share
+        self.on_error = on_error or (lambda name, e: None)
+        self.clock = clock
+        self.jobs = {}
+        self.cpu_log = deque()  # (момент, CPU-секунды) запусков за окно
+        self.now_tick = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def every(self, name, interval, fn, jitter=JITTER, first=None):
+        """Запускать fn() раз в interval секунд; first — задержка первого запуска (по умолчанию случайная фаза)"""
+        job = Job(name, interval, fn, jitter)
+        delay = random.uniform(0, interval) if first is None else first
+        with self._lock:
+            self.jobs[name] = job
+            self._place(job, delay)
+        return job
+
+    def _place(self, job, delay):
+        job.due = self.now_tick + max(1, int(round(delay / self.tick)))
+        self.wheel[job.due % len(self.wheel)].append(job)
+
+    def _next_delay(self, job):
+        return job.interval * (1 + random.uniform(-job.jitter, job.jitter))
+
+    def _cpu_over_budget(self, now):
+        while self.cpu_log and now - self.cpu_log[0][0] > CPU_WINDOW:
+            self.cpu_log.popleft()
+        return sum(c for _, c in self.cpu_log) > self.cpu_share * CPU_WINDOW
+
+    def advance(self):
+        """Один тик: запускает задачи текущего слота, у которых подошёл срок"""
+        with self._lock:
+            self.now_tick += 1
+            slot = self.wheel[self.now_tick % len(self.wheel)]
+            due = [j for j in slot if j.due <= self.now_tick]
+            slot[:] = [j for j in slot if j.due > self.now_tick]
+        for job in due:
+            if self.jobs.get(job.name) is not job:
+                continue  # задачу заменили или сняли
+            if job.last_cpu >= CHEAP_CPU and self._cpu_over_budget(self.clock()):
+                job.deferred += 1
+                MAINT_RUNS.inc(job=job.name, result="deferred")
+                with self._lock:
+                    self._place(job, DEFER)
+                continue
+            self._run(job)
+            with self._lock:
+                self._place(job, self._next_delay(job))
+
+    def _run(self, job):
+        t0, c0 = time.perf_counter(), time.thread_time()
+        result = "ok"
+        try:
+            job.fn()
+        except Exception as e:
+            job.errors += 1
+            result = "error"
+            self.on_error(job.name, e)
+        wall, cpu = time.perf_counter() - t0, time.thread_time() - c0
+        self.cpu_log.append((self.clock(), cpu))
+        job.runs += 1
+        job.last_seconds, job.last_cpu = wall, cpu
+        MAINT_SECONDS.observe(wall, job=job.name)
+        MAINT_CPU.inc(cpu, job=job.name)
+        MAINT_RUNS.inc(job=job.name, result=result)
+
+    def cancel(self, name):
+        with self._lock:
+            return self.jobs.pop(name, None) is not None
+
+    def start(self):
+        if self._thread is not None:
+            return self._thread
+        def loop():
+            next_at = self.clock()
+            while not self._stop.is_set():
+                next_at += self.tick
+                delay = next_at - self.clock()
+                if delay > 0 and self._stop.wait(delay):
+                    break
+                if delay < -len(self.wheel) * self.tick:
+                    next_at = self.clock()  # процесс спал (suspend): не догоняем целые обороты
+                self.advance()
+        self._thread = threading.Thread(target=loop, name="maintenance", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {name: {"interval": j.interval, "runs": j.runs, "errors": j.errors,
+                           "deferred": j.deferred, "last_seconds": round(j.last_seconds, 4)}
+                    for name, j in self.jobs.items()}
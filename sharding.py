@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — multi-core mode
+One process receives updates (polling) and fans them out to N worker
+processes by chat_id. A chat always lands on the same worker, so its
+updates are handled in order and its session is owned by one process.
+summary.json counts what the receiver took in, summary.shard<i>.json what
+worker i handled; only the receiver rotates the shared log files.
+
+    python sharding.py --workers 4
+"""
+
+import os
+import sys
+import time
+import queue
+import signal
+import argparse
+import threading
+import multiprocessing
+
+QUEUE_MAX = 1000          # на воркера; полная очередь тормозит приём (backpressure)
+SUPERVISE_EVERY = 1.0
+RESTART_BACKOFF_MAX = 30.0
+
+def shard_key(upd):
+    """chat_id апдейта (сообщение или callback), 0 — если чата нет"""
+    if "message" in upd:
+        return upd["message"].get("chat", {}).get("id") or 0
+    if "callback_query" in upd:
+        return upd["callback_query"].get("message", {}).get("chat", {}).get("id") or 0
+    return 0
+
+def shard_of(chat_id, n):
+    return int(chat_id) % n
+
+def worker_main(idx, q, n=1):
+    """Процесс-воркер: обрабатывает свои чаты по порядку"""
+    # SIGTERM всей группе: воркер не умирает сразу, а дорабатывает очередь до None от приёмника
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # лимит отправок Telegram — на бота, а не на процесс: каждому воркеру 1/n (SEND_BUDGET)
+    os.environ["PROMPTBINDER_SHARDS"] = str(n)
+    os.environ["PROMPTBINDER_SHARD"] = str(idx)  # свой summary.shard<idx>.json; логи ротирует приёмник
+    import bot_pro_fixed as bot
+    bot.start_maintenance()
+    bot.start_metrics(offset=idx + 1)
+    bot.log_event(f"shard_worker_start idx={idx} pid={os.getpid()}")
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            upd = q.get(timeout=1)
+        except queue.Empty:
+            # приёмник убит без stop() — не остаёмся сиротой
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if upd is None:
+            break
+        bot.handle_update(upd)
+    bot.shutdown()
+
+class Supervisor:
+    """Держит N воркеров живыми и перезапускает упавших с нарастающей паузой"""
+
+    def __init__(self, n, ctx=None):
+        self.ctx = ctx or multiprocessing.get_context("spawn")
+        self.queues = [self.ctx.Queue(maxsize=QUEUE_MAX) for _ in range(n)]
+        self.procs = [None] * n
+        self.restarts = [0] * n
+        self.next_start = [0.0] * n
+        self.stopping = False
+
+    def _start(self, i):
+        p = self.ctx.Process(target=worker_main, args=(i, self.queues[i], len(self.queues)),
+                             name=f"promptbinder-shard-{i}", daemon=True)
+        p.start()
+        self.procs[i] = p
+
+    def start(self):
+        for i in range(len(self.procs)):
+            self._start(i)
+        threading.Thread(target=self._watch, name="shard-supervisor", daemon=True).start()
+
+    def _watch(self):
+        import bot_pro_fixed as bot
+        while not self.stopping:
+            time.sleep(SUPERVISE_EVERY)
+            now = time.time()
+            for i, p in enumerate(self.procs):
+                if p.is_alive() or self.stopping or now < self.next_start[i]:
+                    continue
+                self.restarts[i] += 1
+                delay = min(RESTART_BACKOFF_MAX, 2 ** min(self.restarts[i], 5))
+                bot.log_error(f"shard {i} died (exit {p.exitcode}), restart #{self.restarts[i]}")
+                self.next_start[i] = now + delay
+                self._start(i)
+
+    def dispatch(self, upd):
+        self.queues[shard_of(shard_key(upd), len(self.queues))].put(upd)
+
+    def stop(self, timeout=None):
+        import bot_pro_fixed as bot
+        timeout = bot.DRAIN_TIMEOUT + 5 if timeout is None else timeout
+        self.stopping = True
+        for q in self.queues:
+            q.put(None)
+        for p in self.procs:
+            p.join(timeout)
+
+def run_sharded(workers):
+    import bot_pro_fixed as bot
+    sup = Supervisor(workers)
+    sup.start()
+    for i, q in enumerate(sup.queues):
+        # qsize() не реализован на macOS — тогда метрика просто не выводится
+        bot.QUEUE_DEPTH.set_function(lambda q=q: q.qsize(), queue=f"shard{i}")
+        bot.GOVERNOR.add_queue(q.qsize)
+    # SIGTERM обрабатывает polling(): дорабатывает пачку и возвращается, finally останавливает воркеров
+    bot.log_event(f"sharded_start workers={workers}")
+    try:
+        bot.polling(dispatch=sup.dispatch)
+    finally:
+        sup.stop()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Run PromptBinder with one receiver and N worker processes")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = ap.parse_args(argv)
+    run_sharded(max(1, args.workers))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
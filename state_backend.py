@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — state backends
+Where sessions, dedup keys and the getUpdates offset live.
+
+    MemoryBackend   — всё в памяти процесса (тесты, одноразовые запуски)
+    SQLiteBackend   — chat_history.db; dedup в памяти процесса, offset в таблице kv
+    SQLiteBackend(shared=True) — общий файл на диске для нескольких воркеров:
+                      dedup, offset и сессии видны всем процессам
+
+STATE_BACKEND в config.py: "memory", "sqlite" (по умолчанию) или
+"shared:/path/to/state.db".
+
+    shared — только для процессов на одной машине: WAL sqlite держит индекс
+             в общей памяти, через сеть (NFS, SMB) и между хостами не работает.
+"""
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEDUP_TTL = 2.0
+DEDUP_MAX_ENTRIES = 10000
+
+# WAL-журнал sqlite сливается в основной файл, когда вырастает больше этого
+WAL_COMPACT_BYTES = 4 * 1024 * 1024
+
+def content_hash(text):
+    """Стабильный между перезапусками хэш содержимого (в отличие от hash())"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+class DedupCache:
+    """LRU с TTL для защиты от повторной отправки: память ограничена max_entries.
+    Потокобезопасен: в webhook-режиме апдейты обрабатываются параллельно"""
+
+    def __init__(self, ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> timestamp, от старых к новым
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # записи упорядочены по времени, поэтому просроченные всегда в начале
+        entries = self.entries
+        while entries:
+            key, ts = next(iter(entries.items()))
+            if now - ts < self.ttl:
+                break
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def check_and_add(self, key, now=None, ttl=None):
+        """True — ключ новый (запомнен), False — дубликат в пределах ttl (по умолчанию self.ttl)"""
+        now = time.time() if now is None else now
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._expire(now)
+            ts = self.entries.get(key)
+            if ts is not None and now - ts < ttl:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self.entries.pop(key, None)
+            self.entries[key] = now
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+# ---------------------------
+# Backends
+# ---------------------------
+class MemoryBackend:
+    """Сессии, dedup и offset в памяти процесса"""
+    shared = False
+
+    def __init__(self):
+        self.sessions = {}  # user_id -> dict
+        self.meta = {}
+        self.dedup = DedupCache()
+        self.offset = 0
+        self.inactive = {}  # user_id -> когда бот оказался заблокирован
+
+    def load(self, user_id):
+        return self.sessions.get(user_id)
+
+    def save(self, sessions, meta=None):
+        """sessions: {user_id: dict}, meta: {key: value} той же транзакцией; True при успехе"""
+        users, msgs = self.meta.get('totals') or self.totals()
+        for uid, d in sessions.items():
+            old = self.sessions.get(uid)
+            users += old is None
+            msgs += d.get('message_count', 0) - (old or {}).get('message_count', 0)
+        self.sessions.update(sessions)
+        self.meta.update(meta or {})
+        self.meta['totals'] = [users, msgs]
+        return True
+
+    def totals(self):
+        """(пользователей, сообщений) полным проходом"""
+        msgs = sum(s.get('message_count', 0) for s in self.sessions.values())
+        return len(self.sessions), msgs
+
+    def recent_activity(self, since):
+        """last_action сессий, активных после since"""
+        return [s.get('last_action', 0) for s in self.sessions.values()
+                if s.get('last_action', 0) > since]
+
+    def get_meta(self, key):
+        return self.meta.get(key)
+
+    def recipients(self, after, limit):
+        """Следующие limit user_id после after, без заблокировавших бота"""
+        ids = sorted(uid for uid, s in self.sessions.items()
+                     if uid > after and s.get('last_action', 0) > self.inactive.get(uid, -1))
+        return ids[:limit]
+
+    def mark_inactive(self, user_ids):
+        now = time.time()
+        self.inactive.update((uid, now) for uid in user_ids)
+
+    def check_dedup(self, key, ttl=DEDUP_TTL):
+        return self.dedup.check_and_add(key, ttl=ttl)
+
+    def dedup_stats(self):
+        return self.dedup.stats()
+
+    def get_offset(self):
+        return self.offset
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def compact(self):
+        pass
+
+    def maybe_compact(self):
+        pass
+
+class SQLiteBackend:
+    """Сессии в sqlite; с shared=True ещё dedup и offset — для нескольких процессов"""
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.dedup = DedupCache()
+        self._compacting = False
+        self._lock = threading.RLock()
+        self.db = self._connect()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS user_states ("
+            "user_id TEXT PRIMARY KEY, state TEXT NOT NULL, "
+            "last_action REAL NOT NULL DEFAULT 0, message_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS user_states_last_action ON user_states (last_action)")
+        db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, ts REAL NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS inactive (user_id TEXT PRIMARY KEY, ts REAL NOT NULL)")
+        return db
+
+    def load(self, user_id):
+        with self._lock:
+            row = self.db.execute("SELECT state FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sessions, meta=None):
+        rows = [(uid, json.dumps(d, ensure_ascii=False, separators=(',', ':')),
+                 d.get('last_action', 0), d.get('message_count', 0)) for uid, d in sessions.items()]
+        with self._lock:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                totals = self._totals_delta(rows)
+                self.db.executemany(
+                    "INSERT INTO user_states (user_id, state, last_action, message_count) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET "
+                    "state=excluded.state, last_action=excluded.last_action, "
+                    "message_count=excluded.message_count", rows)
+                for key, value in (meta or {}).items():
+                    self._set_kv("meta:" + key, json.dumps(value))
+                self._set_kv("meta:totals", json.dumps(totals or self.totals()))
+                self.db.execute("COMMIT")
+            except Exception:
+                try:
+                    self.db.execute("ROLLBACK")
+                except Exception:
+                    pass
+                return False
+        self.maybe_compact()
+        return True
+
+    def _totals_delta(self, rows):
+        """Счётчики после записи rows: хранимые плюс разница по этим строкам. Считается внутри
+        транзакции записи, поэтому процессы с одним файлом не затирают счётчики друг друга;
+        None — счётчиков ещё нет (посчитать агрегатом после записи)"""
+        row = self.db.execute("SELECT value FROM kv WHERE key = 'meta:totals'").fetchone()
+        if row is None:
+            return None
+        users, msgs = json.loads(row[0])
+        ids = [r[0] for r in rows]
+        old = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            old.update(self.db.execute(
+                "SELECT user_id, message_count FROM user_states WHERE user_id IN (%s)"
+                % ",".join("?" * len(chunk)), chunk))
+        for uid, _, _, count in rows:
+            users += uid not in old
+            msgs += count - old.get(uid, 0)
+        return [users, msgs]
+
+    def totals(self):
+        """(пользователей, сообщений) агрегатом по таблице"""
+        with self._lock:
+            return tuple(self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(message_count), 0) FROM user_states").fetchone())
+
+    def recent_activity(self, since):
+        # идёт по индексу last_action: цена зависит от числа активных, а не от всей истории
+        with self._lock:
+            return [ts for (ts,) in self.db.execute(
+                "SELECT last_action FROM user_states WHERE last_action > ?", (since,))]
+
+    def _set_kv(self, key, value):
+        self.db.execute("INSERT INTO kv (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM kv WHERE key = ?", ("meta:" + key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recipients(self, after, limit):
+        """Следующие limit user_id после after по первичному ключу; чат, написавший
+        после блокировки, снова получатель"""
+        with self._lock:
+            return [uid for (uid,) in self.db.execute(
+                "SELECT u.user_id FROM user_states u LEFT JOIN inactive i ON i.user_id = u.user_id "
+                "WHERE u.user_id > ? AND (i.ts IS NULL OR u.last_action > i.ts) "
+                "ORDER BY u.user_id LIMIT ?", (after, limit))]
+
+    def mark_inactive(self, user_ids):
+        now = time.time()
+        with self._lock:
+            self.db.executemany("INSERT INTO inactive (user_id, ts) VALUES (?, ?) "
+                                "ON CONFLICT(user_id) DO UPDATE SET ts=excluded.ts",
+                                [(uid, now) for uid in user_ids])
+
+    def check_dedup(self, key, ttl=DEDUP_TTL):
+        if not self.shared:
+            return self.dedup.check_and_add(key, ttl=ttl)
+        now = time.time()
+        with self._lock:
+            # одна транзакция: ключ вставляется, только если его нет или он протух
+            cur = self.db.execute(
+                "INSERT INTO dedup (key, ts) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET ts=excluded.ts WHERE dedup.ts <= ?",
+                (key, now, now - ttl))
+            fresh = cur.rowcount == 1
+        if fresh:
+            self.dedup.misses += 1
+        else:
+            self.dedup.hits += 1
+        return fresh
+
+    def dedup_stats(self):
+        return self.dedup.stats()
+
+    def expire_dedup(self, ttl=DEDUP_TTL):
+        """Чистит протухшие ключи общей таблицы dedup"""
+        if not self.shared:
+            return 0
+        with self._lock:
+            n = self.db.execute("DELETE FROM dedup WHERE ts <= ?", (time.time() - ttl,)).rowcount
+        self.dedup.evictions += n
+        return n
+
+    def get_offset(self):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM kv WHERE key = 'offset'").fetchone()
+        return int(row[0]) if row else 0
+
+    def set_offset(self, offset):
+        with self._lock:
+            self._set_kv("offset", str(offset))
+
+    def maybe_compact(self):
+        """Сливает WAL в основной файл в фоне, не блокируя обработчик"""
+        try:
+            wal_size = os.path.getsize(self.path + "-wal")
+        except OSError:
+            return
+        if wal_size < WAL_COMPACT_BYTES or self._compacting:
+            return
+        self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        try:
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            db.close()
+        except Exception:
+            pass
+        finally:
+            self._compacting = False
+
+def make_backend(spec, default_path):
+    """Backend по строке из config.STATE_BACKEND"""
+    spec = (spec or "sqlite").strip()
+    if spec == "memory":
+        return MemoryBackend()
+    if spec == "sqlite":
+        return SQLiteBackend(default_path)
+    if spec.startswith("shared:"):
+        return SQLiteBackend(spec[len("shared:"):] or default_path, shared=True)
+    raise ValueError(f"unknown STATE_BACKEND: {spec}")
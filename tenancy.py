@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — several bots in one process
+Every entry of BOTS in config.py is a tenant: its own copy of the
+bot_pro_fixed module with the entry's values laid over config.py, and its
+own data directory DATA_DIR/<name>/ (sessions, dedup, offset, stats, logs).
+The HTTP connection pool, callback-ack workers, getUpdates pool, generation
+and bulk queues, maintenance scheduler (pools.py), compiled catalogs
+(catalog.py) and the /metrics endpoint are shared by the whole process;
+/metrics shows the bots together (counts and queue depths summed, the worst
+degradation level and circuit state), summary.json is per bot.
+
+    BOTS = [
+        {"name": "main", "BOT_TOKEN": "123:AAA"},
+        {"name": "legacy", "BOT_TOKEN": "456:BBB", "PROMPTS_FILE": "prompts_legacy.json"},
+    ]
+
+    python tenancy.py
+"""
+
+import os
+import re
+import sys
+import signal
+import argparse
+import threading
+import importlib.util
+
+import pools
+import metrics
+
+BOT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_pro_fixed.py")
+
+def load_tenant(spec):
+    """Копия модуля бота для одного tenant; spec — {"name": ..., "BOT_TOKEN": ..., ...}"""
+    name = spec.get("name") or ""
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+        raise ValueError(f"tenant name must be [A-Za-z0-9_-]+: {name!r}")
+    mod_spec = importlib.util.spec_from_file_location(f"promptbinder_{name}", BOT_SOURCE)
+    bot = importlib.util.module_from_spec(mod_spec)
+    bot.TENANT = dict(spec)  # читается модулем при исполнении
+    sys.modules[mod_spec.name] = bot
+    mod_spec.loader.exec_module(bot)
+    return bot
+
+def load_all(specs):
+    names = [s.get("name") for s in specs]
+    dup = {n for n in names if names.count(n) > 1}
+    if dup:
+        raise ValueError(f"duplicate tenant names: {sorted(dup)}")
+    return [load_tenant(s) for s in specs]
+
+def run(specs):
+    # прогрев всех ботов (каталог, якорь) до того, как кто-то из них начнёт приём
+    pools.TENANTS = len(specs)
+    bots = load_all(specs)
+
+    def stop(*args):
+        for bot in bots:
+            bot.request_stop(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    port = os.environ.get("PROMPTBINDER_METRICS_PORT") or getattr(bots[0].config, "METRICS_PORT", None)
+    if port:
+        metrics.serve(int(port))
+    threads = [threading.Thread(target=bot.polling, name=f"polling-{bot.TENANT['name']}") for bot in bots]
+    for t in threads:
+        t.start()
+    print(f"tenancy: {len(bots)} bots polling: {', '.join(b.TENANT['name'] for b in bots)}")
+    for t in threads:
+        t.join()
+    pools.shutdown()
+    return 0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Run every bot from config.BOTS in one process")
+    ap.parse_args(argv)
+    try:
+        import config
+    except Exception:
+        raise SystemExit("Create config.py with BOTS in same folder.")
+    specs = getattr(config, "BOTS", None)
+    if not specs:
+        raise SystemExit("BOTS missing in config.py")
+    return run(specs)
+
+if __name__ == "__main__":
+    sys.exit(main())
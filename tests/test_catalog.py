@@ -0,0 +1,20 @@
+from catalog import parse_form
+
+FIELDS = ["новость", "стиль"]
+
+
+def test_multiline_answer_to_first_field_is_one_value():
+    assert parse_form("Курс рубля вырос.\nАналитики ждут продолжения.", FIELDS) is None
+
+
+def test_multiline_answer_with_unrelated_colon_is_one_value():
+    assert parse_form("ЦБ снизил ставку.\nИсточник: РБК", FIELDS) is None
+
+
+def test_keyed_lines_fill_several_fields():
+    assert parse_form("стиль: деловой\nновость: ЦБ снизил ставку", FIELDS) == {
+        "новость": "ЦБ снизил ставку", "стиль": "деловой"}
+
+
+def test_plain_answer_is_not_a_form():
+    assert parse_form("ЦБ снизил ставку", FIELDS) is None
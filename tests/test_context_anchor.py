@@ -0,0 +1,30 @@
+from context_anchor import ChatHistory
+from state_backend import make_backend
+
+
+def _pair(tmp_path):
+    spec = "shared:" + str(tmp_path / "state.db")
+    return ChatHistory(make_backend(spec, None)), ChatHistory(make_backend(spec, None))
+
+
+def test_shared_read_does_not_keep_stale_session(tmp_path):
+    a, b = _pair(tmp_path)
+    a.update_user_state(1, current_prompt="x")
+    assert a.get_flow(1) is None  # воркер A прочитал чат
+
+    b.set_flow(1, {"state": "filling", "prompt_key": "x", "fields": ["f"], "index": 0, "data": {}})
+    a.update_user_state(1, current_prompt="x")  # A не должен записать свою старую копию
+
+    flow = ChatHistory(make_backend("shared:" + str(tmp_path / "state.db"), None)).get_flow(1)
+    assert flow is not None and flow["state"] == "filling"
+
+
+def test_shared_reads_leave_nothing_resident(tmp_path):
+    a, b = _pair(tmp_path)
+    for uid in range(20):
+        b.update_user_state(uid)
+    for uid in range(20):
+        a.get_flow(uid)
+        a.get_value(uid, "menu_id")
+        a.get_user_state(uid)
+    assert len(a.user_states) == 0
@@ -0,0 +1,31 @@
+from error_index import build_index, fingerprint
+
+TRACE = (b'[2025-12-09 15:56:28] handler failed\n'
+         b'Traceback (most recent call last):\n'
+         b'  File "bot_pro_fixed.py", line 10, in handle_update\n'
+         b'  File "catalog.py", line 20, in parse_form\n'
+         b'KeyError: \'topic\'\n')
+
+
+def test_entry_written_in_parts_is_indexed_once_and_whole(tmp_path):
+    log = tmp_path / "bot_errors.log"
+    log.write_bytes(b"[2025-12-09 15:50:00] post error sendMessage: timeout\n" + TRACE[:90])
+    build_index(str(log))
+    with open(log, "ab") as f:
+        f.write(TRACE[90:])
+    idx, _, _ = build_index(str(log))
+    assert idx["entries"] == 2
+    assert idx["groups"][fingerprint(TRACE.decode().rstrip())[0]]["count"] == 1
+    assert sum(g["count"] for g in idx["groups"].values()) == 2
+
+
+def test_incremental_run_matches_rebuild(tmp_path):
+    log = tmp_path / "bot_errors.log"
+    log.write_bytes(TRACE)
+    build_index(str(log))
+    with open(log, "ab") as f:
+        f.write(TRACE)
+    idx, _, _ = build_index(str(log))
+    full, _, _ = build_index(str(log), str(tmp_path / "full.idx.json"), rebuild=True)
+    assert idx["groups"] == full["groups"]
+    assert idx["entries"] == full["entries"] == 2
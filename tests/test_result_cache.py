@@ -0,0 +1,36 @@
+from metrics import ratio
+from result_cache import ResultCache
+
+LIMIT = 256 * 1024
+VALUE = "x" * 2000
+
+
+def test_size_limit_holds_for_processes_sharing_one_file(tmp_path):
+    path = str(tmp_path / "results.db")
+    a = ResultCache(path, disk_max_bytes=LIMIT)
+    b = ResultCache(path, disk_max_bytes=LIMIT)
+    for i in range(200):
+        (a if i % 2 else b).put(f"k{i}", VALUE)
+    assert a.disk_bytes() <= LIMIT
+    assert b.disk_bytes() == a.disk_bytes()
+    # вытесняются давно не читанные, свежие остаются
+    assert a.conn.execute("SELECT 1 FROM results WHERE key = 'k199'").fetchone()
+    assert not a.conn.execute("SELECT 1 FROM results WHERE key = 'k0'").fetchone()
+
+
+def test_deleted_rows_free_space_for_new_ones(tmp_path):
+    cache = ResultCache(str(tmp_path / "results.db"), disk_max_bytes=LIMIT)
+    for i in range(400):
+        cache.put(f"k{i}", VALUE)
+    assert cache.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] > 50
+
+
+def test_hit_ratio_is_pooled_across_bots(tmp_path):
+    a = ResultCache(str(tmp_path / "a.db"))
+    b = ResultCache(str(tmp_path / "b.db"))
+    a.put("k", "v")
+    for _ in range(3):
+        a.get("k")
+    b.get("k")
+    assert a.lookups() == (3, 3) and b.lookups() == (0, 1)
+    assert ratio([a.lookups(), b.lookups()]) == 0.75
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+PromptBinder — per-update tracing and sampling profiler
+Every update gets a trace id "<update_id>-<chat_id>"; spans opened while it
+is handled are written as one JSON line per update when tracing is on:
+
+    TRACE_FILE = "traces.jsonl"    # config.py или PROMPTBINDER_TRACE
+    TRACE_MIN_MS = 50              # писать только медленные апдейты
+
+    python tracing.py chrome traces.jsonl > trace.json   # chrome://tracing, Perfetto
+
+The profiler samples all thread stacks for N seconds and writes collapsed
+stacks ("a;b;c count"), ready for flamegraph.pl or speedscope.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import Counter
+
+_local = threading.local()
+_write_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+trace_file = None
+trace_min_ms = 0.0
+
+def configure(path, min_ms=0):
+    """Включает запись трасс в path (None — выключает)"""
+    global trace_file, trace_min_ms
+    trace_file = path or None
+    trace_min_ms = float(min_ms or 0)
+
+# ---------------------------
+# Spans
+# ---------------------------
+def begin(update_id, chat_id):
+    """Открывает трассу апдейта в текущем потоке"""
+    if trace_file is None:
+        _local.trace = None
+        return
+    _local.trace = {"trace_id": f"{update_id}-{chat_id}", "update_id": update_id, "chat_id": chat_id,
+                    "ts": time.time(), "t0": time.perf_counter(), "depth": 0, "spans": []}
+
+def end():
+    """Закрывает трассу и дописывает её строкой в trace_file"""
+    tr = getattr(_local, "trace", None)
+    _local.trace = None
+    if tr is None or trace_file is None:
+        return
+    dur = (time.perf_counter() - tr.pop("t0")) * 1000
+    if dur < trace_min_ms:
+        return
+    tr.pop("depth")
+    tr["dur_ms"] = round(dur, 3)
+    tr["pid"] = os.getpid()
+    line = json.dumps(tr, ensure_ascii=False)
+    try:
+        with _write_lock, open(trace_file, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except Exception:
+        pass
+
+@contextmanager
+def span(name):
+    """with span("x"): или @span("x") — участок трассы; без активной трассы ничего не делает"""
+    tr = getattr(_local, "trace", None)
+    if tr is None:
+        yield
+        return
+    start = time.perf_counter()
+    depth = tr["depth"]
+    tr["depth"] = depth + 1
+    try:
+        yield
+    finally:
+        tr["depth"] = depth
+        tr["spans"].append({"name": name, "depth": depth,
+                            "start_ms": round((start - tr["t0"]) * 1000, 3),
+                            "dur_ms": round((time.perf_counter() - start) * 1000, 3)})
+
+def to_chrome(lines):
+    """Трассы JSONL -> события Chrome trace format (complete events, ph="X")"""
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        tr = json.loads(line)
+        base = tr["ts"] * 1e6
+        tid = tr.get("chat_id") or 0
+        events.append({"name": f"update {tr['trace_id']}", "ph": "X", "ts": base, "dur": tr["dur_ms"] * 1000,
+                       "pid": tr.get("pid", 0), "tid": tid, "args": {"trace_id": tr["trace_id"]}})
+        for s in tr["spans"]:
+            events.append({"name": s["name"], "ph": "X", "ts": base + s["start_ms"] * 1000,
+                           "dur": s["dur_ms"] * 1000, "pid": tr.get("pid", 0), "tid": tid})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# ---------------------------
+# Sampling profiler
+# ---------------------------
+def _stack(frame):
+    out = []
+    while frame is not None:
+        code = frame.f_code
+        out.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    out.reverse()
+    return ";".join(out)
+
+def sample_profile(seconds, out_path, interval=0.005):
+    """Снимает стеки всех потоков каждые interval секунд; пишет collapsed stacks, возвращает число сэмплов"""
+    me = threading.get_ident()
+    names = {}
+    stacks = Counter()
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for t in threading.enumerate():
+            names[t.ident] = t.name
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stacks[f"{names.get(ident, ident)};{_stack(frame)}"] += 1
+        samples += 1
+        time.sleep(interval)
+    with open(out_path, "w", encoding="utf-8") as f:
+        for stack, n in stacks.most_common():
+            f.write(f"{stack} {n}\n")
+    return samples
+
+def start_profile(seconds, out_path, on_done, interval=0.005):
+    """Профилирует в фоне и вызывает on_done(out_path, samples); False — профиль уже идёт"""
+    if not _profile_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            on_done(out_path, sample_profile(seconds, out_path, interval))
+        finally:
+            _profile_lock.release()
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+    return True
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Convert PromptBinder traces")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ch = sub.add_parser("chrome", help="JSONL traces -> Chrome trace format")
+    ch.add_argument("file")
+    args = ap.parse_args(argv)
+    with open(args.file, "r", encoding="utf-8") as f:
+        json.dump(to_chrome(f), sys.stdout)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())